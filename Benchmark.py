@@ -0,0 +1,121 @@
+# ************************************************************************
+# *   Copyright (c) Stefan Troeger (stefantroeger@gmx.net) 2021          *
+# *                                                                      *
+# *   This library is free software; you can redistribute it and/or      *
+# *   modify it under the terms of the GNU Library General Public        *
+# *   License as published by the Free Software Foundation; either       *
+# *   version 2 of the License, or (at your option) any later version.   *
+# *                                                                      *
+# *   This library  is distributed in the hope that it will be useful,   *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of     *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the      *
+# *   GNU Library General Public License for more details.               *
+# *                                                                      *
+# *   You should have received a copy of the GNU Library General Public  *
+# *   License along with this library; see the file COPYING.LIB. If not, *
+# *   write to the Free Software Foundation, Inc., 59 Temple Place,      *
+# *   Suite 330, Boston, MA  02111-1307, USA                             *
+# ************************************************************************
+
+# Microbenchmark of the BatchedOrderedRunner dispatch. Does not require FreeCAD, run it from the addon directory:
+#   python Benchmark.py [number of tasks]
+#
+# The runner is set up with the batchers of an OnlineObject (three EquallityBatchers plus a MultiBatcher). For
+# different task patterns it reports the time to queue all tasks, and to drain them together with the average cost
+# per dispatch (choosing the next batch and executing it). All tasks are queued before the first dispatch, as the 
+# runner only starts when the event loop is entered.
+
+import asyncio, logging, random, sys, time
+import Documents.Batcher as Batcher
+from Documents.AsyncRunner import BatchedOrderedRunner
+
+DefaultTasks = 10000
+
+
+class OnlineObject():
+    #stand-in with the task and batch handler names of a real OnlineObject
+
+    def __init__(self):
+        self.executed = 0
+
+    def __addDynamicProperty(self, value):
+        self.executed += 1
+
+    def __changeProperty(self, value):
+        self.executed += 1
+
+    def __changePropertyStatus(self, value):
+        self.executed += 1
+
+    async def recompute(self):
+        self.executed += 1
+
+    async def flush(self):
+        pass
+
+
+def setupRunner(obj):
+
+    runner = BatchedOrderedRunner(logging.getLogger("Benchmark"), highWaterMark=0)
+    batchers = [Batcher.EquallityBatcher("OnlineObject.__addDynamicProperty", obj.flush),
+                Batcher.EquallityBatcher("OnlineObject.__changeProperty", obj.flush),
+                Batcher.EquallityBatcher("OnlineObject.__changePropertyStatus", obj.flush)]
+
+    for batcher in batchers:
+        runner.registerBatcher(batcher)
+    runner.registerBatcher(Batcher.MultiBatcher([batcher.copy() for batcher in batchers]))
+    return runner
+
+
+def taskPattern(obj, pattern, num):
+    #returns the functions to queue for the given pattern
+
+    random.seed(1)
+    change = obj._OnlineObject__changeProperty
+    status = obj._OnlineObject__changePropertyStatus
+    dynamic = obj._OnlineObject__addDynamicProperty
+
+    if pattern == "runs":
+        #two long batchable runs
+        return [change if i < num/2 else status for i in range(num)]
+
+    if pattern == "mixed":
+        #all batchable by the MultiBatcher
+        return [random.choice([change, status, dynamic]) for i in range(num)]
+
+    #every second task is not batchable
+    return [obj.recompute if i%2 else change for i in range(num)]
+
+
+async def measure(pattern, num):
+
+    obj = OnlineObject()
+    runner = setupRunner(obj)
+
+    fncs = taskPattern(obj, pattern, num)
+    started = time.perf_counter()
+    for index, fnc in enumerate(fncs):
+        if fnc == obj.recompute:
+            runner.run(fnc)
+        else:
+            runner.run(fnc, index)
+    queued = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await runner.waitTillCloseout(60)
+    drained = time.perf_counter() - started
+    dispatches = sum(hist["count"] for hist in runner.metrics()["execution"].values())
+
+    if obj.executed != num:
+        raise Exception(f"Only {obj.executed} of {num} tasks executed")
+
+    await runner.close()
+    print(f"{pattern:12s} queue {queued*1e3:8.1f} ms   "
+          f"drain {drained*1e3:8.1f} ms ({dispatches} dispatches, {drained*1e6/max(dispatches, 1):6.1f} us each)")
+
+
+if __name__ == "__main__":
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else DefaultTasks
+    for pattern in ["runs", "mixed", "interleaved"]:
+        asyncio.run(measure(pattern, num))
@@ -17,26 +17,87 @@
 # *   Suite 330, Boston, MA  02111-1307, USA                             *
 # ************************************************************************
 
-import asyncio
-import Documents.Batcher as Batcher
+import asyncio, contextvars, os
+from Documents.Metrics import RunnerMetrics
+from collections import deque
+from enum import Enum
+
+#default amount of queued tasks above which a runner reports backpressure to its callers
+DefaultHighWaterMark = 1000
+
+#default amount of worker coroutines a DocumentScheduler uses to drain its runners
+DefaultWorkers = 8
+
+#default debounce of batchable runners: wait the given fraction of the measured node round trip time for more
+#batchable tasks before starting, but never longer than the maximal latency (in seconds)
+DefaultDebounceFactor  = 0.5
+DefaultDebounceLatency = 0.02
+
+#defaults of the global scheduler arbitration: amount of steps executed concurrently over all documents, time budget
+#of each scheduler per round and the maximal duration of a round (in seconds)
+DefaultSlots      = 8
+DefaultBudget     = 0.05
+DefaultRoundTime  = 0.5
+
+
+class SyncMode(Enum):
+    # How the outgoing tasks of the objects in a document are ordered. Values as used in FC_OCP_SYNC_MODE
+    Object     = "0"    # each object has its own runner, document wide order is established by syncers
+    Document   = "1"    # all objects share a single DocumentRunner ("Document-Sync")
+    Dependency = "2"    # each object has its own runner, but waits for the objects it depends on ("Dependency-Sync")
+    
+    
+def syncModeFromEnvironment():
+    # returns the SyncMode configured by the FC_OCP_SYNC_MODE environment variable
+    
+    try:
+        return SyncMode(os.getenv('FC_OCP_SYNC_MODE', "0"))
+    except ValueError:
+        return SyncMode.Object
+
+def autoSyncFromEnvironment():
+    # true if FC_OCP_SYNC_MODE requests to choose the SyncMode automatically ("auto"). Starts with the default mode
+    return os.getenv('FC_OCP_SYNC_MODE', "0") == "auto"
 
 class Task():
     # Wraps a function to be called as Task
     # Works for async and normal functions, with arbitrary arguments
+    # Blocking tasks (e.g. syncers) may wait for outside events and are not executed by scheduler workers
+    # Tasks with a key can be coalesced by the runner as long as they did not start
+    # Tasks with "after" tickets ([(runner, count)]) do not start before those runners finished count tasks
+    # Tasks whose function returns a future are finished when the future is done
     
-    def __init__(self, fnc, args):
+    def __init__(self, fnc, args, blocking = False, key = None, after = None):
         self.Func = fnc 
         self.Args = args
+        self.Blocking = blocking
+        self.Key = key
+        self.After = after
+        self.Started = False
+        self.Name = taskName(fnc)
+        self.Queued = 0     #time of queueing, set by the runner
+        self.Epoch = 0      #epoch of the runners barrier when queued
         
     async def execute(self):
+        #returns the result of the function. Runners treat a returned future as not yet finished task
         
+        self.Started = True
         if asyncio.iscoroutinefunction(self.Func):
-            await self.Func(*self.Args)
+            return await self.Func(*self.Args)
         else:
-            self.Func(*self.Args)
+            return self.Func(*self.Args)
                 
     def name(self):
-        return self.Func.__self__.__class__.__name__ + "." + self.Func.__name__
+        return self.Name
+
+
+def taskName(fnc):
+    # Name of the task executing the given function, as used by batchers: "Class.function" for methods
+    
+    try:
+        return fnc.__self__.__class__.__name__ + "." + fnc.__name__
+    except AttributeError:
+        return fnc.__qualname__
 
 
 class _TaskErrorHandler():
@@ -50,17 +111,48 @@ class _TaskErrorHandler():
         
     async def _handleError(self, error):
         
-        for predicate, task in self.__handler:
+        for predicate, task in self.__handler.items():
             if predicate(error):
-                await task.execute
+                await task.execute()
                 return True
         
         return False
 
 
+class _TaskBackpressure():
+    # Base class for runners that unifies the backpressure reporting. If more tasks than the high water mark
+    # are queued the runner is congested, and run() reports this to the caller, so that producers can throttle
+    # or coalesce their work instead of growing the queue without limit
+    
+    def __init__(self, logger, highWaterMark):
+        self.__logger       = logger
+        self.__congested    = False
+        self.HighWaterMark  = highWaterMark
+    
+    def _checkBackpressure(self, queued):
+        # returns True if the runner is congested. Congestion is logged once when the high water mark is
+        # crossed, and reset when the queue is drained below half of it
+        
+        if not self.HighWaterMark:
+            return False
+        
+        if queued >= self.HighWaterMark:
+            if not self.__congested:
+                self.__congested = True
+                self.__logger.warning(f"Runner congested: {queued} tasks queued")
+                
+        elif self.__congested and queued < self.HighWaterMark/2:
+            self.__congested = False
+            
+        return self.__congested
+
+
 class DocumentRunner():
     #Generates sender and receiver DocumentBatchedOrderedRunner for a whole document where all actions on all 
-    #individual runners are executed in order
+    #individual runners are executed in order (SyncMode.Document). 
+    #Note: In SyncMode.Dependency no document runner is used. There the object runners build the dependency graph 
+    #      themself: a task that is queued with the runners of the objects it depends on waits only for the tasks
+    #      already queued in those runners, and hence only dependent chains are serialized.
     
     __sender   = {}
     __receiver = {}
@@ -80,208 +172,742 @@ class DocumentRunner():
         return DocumentBatchedOrderedRunner(DocumentRunner.__receiver[docId])
             
     
-class OrderedRunner(_TaskErrorHandler):
-    #AsyncRunner which runs task in order
-   
-    #runs all tasks synchronous
-    def __init__(self, logger):
+class SchedulerArbiter():
+    #Global gate for the steps of all DocumentSchedulers, so that documents do not compete without limits for the
+    #event loop. Only a fixed amount of steps is executed concurrently. If more are requested, the free slot is given
+    #to the waiting scheduler that used the least time in the current round, whereby interactive schedulers (changes
+    #of the local user) are preferred as long as they are within their budget. A round ends if all waiting schedulers
+    #used up their budget or the maximal round time passed
+    #Steps that wait for other runners (see waitSuspended) give their slot away meanwhile, so that they cannot block 
+    #the runners they wait for
+    
+    def __init__(self, slots = DefaultSlots, roundTime = DefaultRoundTime):
         
-        _TaskErrorHandler.__init__(self)
+        self.__free       = slots
+        self.__roundTime  = roundTime
+        self.__roundStart = 0
+        self.__used       = {}      #scheduler -> time used in the current round
+        self.__last       = {}      #scheduler -> time used in the last round
+        self.__waiting    = {}      #scheduler -> deque of futures waiting for a slot
+        
+        
+    async def acquire(self, scheduler):
+        #returns when the scheduler is allowed to execute a step. release() must be called afterwards
+        
+        if scheduler not in self.__used:
+            self.__used[scheduler] = 0
+        
+        if self.__free > 0 and not self.__waiting:
+            self.__free -= 1
+            return
+        
+        waiter = asyncio.get_event_loop().create_future()
+        self.__waiting.setdefault(scheduler, deque()).append(waiter)
+        try:
+            await waiter
+            
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                #we got the slot already, hand it over
+                self.release(scheduler, 0)
+            else:
+                waiter.cancel()
+            raise
+        
+        
+    def release(self, scheduler, duration):
+        #a step of the scheduler finished after the given time in seconds
         
-        self.__logger        = logger
-        self.__tasks         = []
-        self.__syncEvent     = asyncio.Event() 
-        self.__finishEvent   = asyncio.Event()
-        self.__current       = ""
+        if scheduler in self.__used:
+            self.__used[scheduler] += duration
         
-        self.__maintask = asyncio.ensure_future(self.__run())
+        now = asyncio.get_event_loop().time()
+        if now - self.__roundStart > self.__roundTime:
+            self.__newRound(now)
+        
+        waiter = self.__next()
+        if waiter:
+            waiter.set_result(True)
+        else:
+            self.__free += 1
+            
+            
+    def share(self, scheduler):
+        #fraction of the execution time used by the scheduler in the last round
+        
+        total = sum(self.__last.values())
+        return self.__last.get(scheduler, 0) / total if total else 0
+            
+            
+    def remove(self, scheduler):
+        
+        self.__used.pop(scheduler, None)
+        self.__last.pop(scheduler, None)
+        
+        
+    def __next(self):
+        #returns the waiter that gets the next slot, or None if nobody waits
+        
+        while self.__waiting:
+            candidates = [s for s in self.__waiting if self.__used.get(s, 0) < s.Budget]
+            if not candidates:
+                self.__newRound(asyncio.get_event_loop().time())
+                candidates = list(self.__waiting)
+            
+            scheduler = min(candidates, key = lambda s: (not s.Interactive, self.__used.get(s, 0)))
+            waiters = self.__waiting[scheduler]
+            waiter  = waiters.popleft()
+            if not waiters:
+                del self.__waiting[scheduler]
+                
+            if not waiter.done():
+                return waiter
+            
+        return None
+    
+    
+    def __newRound(self, now):
+        
+        self.__last       = self.__used
+        self.__used       = dict.fromkeys(self.__used, 0)
+        self.__roundStart = now
+        
+        
+#arbiter used by all schedulers
+Arbiter = SchedulerArbiter()
 
-   
+
+class _StepSlot():
+    #Arbiter slot held by the scheduler step executed in the current context
+    
+    def __init__(self, arbiter, scheduler):
+        self.Arbiter   = arbiter
+        self.Scheduler = scheduler
+        self.Held      = True
+        self.Suspended = 0      #seconds the slot was given away while the step waited
+
+_CurrentSlot = contextvars.ContextVar("_CurrentSlot", default=None)
+
+
+async def waitSuspended(awaitable):
+    #Awaits something that depends on the progress of other runners, e.g. their closeout. If called from within a 
+    #scheduler step, its arbiter slot is given away during the wait: the other runners may need it, and otherwise 
+    #the steps of one scheduler could hold all slots while waiting for runners that cannot start
+    
+    slot = _CurrentSlot.get()
+    if slot is None or not slot.Held:
+        return await awaitable
+    
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    slot.Held = False
+    slot.Arbiter.release(slot.Scheduler, 0)
+    try:
+        return await awaitable
+    
+    finally:
+        await slot.Arbiter.acquire(slot.Scheduler)
+        slot.Held = True
+        slot.Suspended += loop.time() - started
+    
+
+class DocumentScheduler():
+    #Executes the runners of a whole document with a small fixed pool of worker coroutines. Each runner keeps its
+    #own FIFO queue, only runners with queued work are known to the scheduler. A worker processes a single step of 
+    #a runner (a task or a batch) and requeues it at the end, which gives round robin fairness between the runners 
+    #while keeping the order of tasks within each runner. Memory and scheduling overhead hence scale with the active
+    #runners, not with the number of objects in the document
+    
+    def __init__(self, logger, workers = DefaultWorkers, arbiter = Arbiter):
+        
+        self.__logger     = logger
+        self.__arbiter    = arbiter
+        self.__ready      = asyncio.Queue()
+        self.__numWorkers = workers
+        self.__workers    = []
+        self.__closed     = False
+        self.__factor     = 0       #debounce factor, 0 means no debouncing
+        self.__maxLatency = 0       #upper bound of the debounce window in seconds
+        self.__roundTrip  = 0       #moving average of the batch execution time in seconds
+        self.__active     = set()   #runners with queued or executing tasks
+        self.__waiters    = []      #futures of waitTillCloseout calls
+        
+        self.Metrics      = RunnerMetrics()    #collected for all runners of this scheduler
+        self.Interactive  = False   #true if the runners execute changes of the local user, prioritized by the arbiter
+        self.Budget       = DefaultBudget   #execution time per arbiter round in seconds
+        
+        
+    def setDebounce(self, factor = DefaultDebounceFactor, maxLatency = DefaultDebounceLatency):
+        #Runners whose next task is batchable wait factor * round trip time before they start, so that a burst of
+        #tasks ends up in a single batch. The wait is never longer than maxLatency seconds. A factor of 0 disables it
+        
+        self.__factor     = factor
+        self.__maxLatency = maxLatency
+        
+        
+    def debounceWindow(self):
+        #the current accumulation window in seconds
+        return min(self.__factor*self.__roundTrip, self.__maxLatency)
+        
+        
+    def share(self):
+        #fraction of the execution time of all schedulers that was used by this one in the last arbiter round
+        return self.__arbiter.share(self)
+    
+    
+    def idle(self):
+        #true if none of the runners has work
+        return not self.__active
+    
+    
+    def busy(self):
+        #returns a description of all runners with outstanding work
+        return [f"{runner._logger.name}: {runner._current} ({len(runner._tasks)} queued)" for runner in self.__active]
+    
+    
     async def waitTillCloseout(self, timeout = 10):
+        #Returns when all runners finished their tasks. This is a single wait independent of the number of runners
+        
+        if not self.__active:
+            return
+        
+        waiter = asyncio.get_event_loop().create_future()
+        self.__waiters.append(waiter)
         try:
-            await asyncio.wait_for(self.__finishEvent.wait(), timeout)
+            await waitSuspended(asyncio.wait_for(waiter, timeout))
             
         except asyncio.TimeoutError as e:
-            remaining = self.queued()
-            self.__logger.error(f"Runner closeout timed out while working ({not self.__maintask.done()}) on {self.__current}. Remaining: \n{remaining}")     
-         
-
+            busy = "\n".join(self.busy())
+            self.__logger.error(f"Closeout timed out. Busy runners: \n{busy}")
+        
+        
     async def close(self):
-        await self.waitTillCloseout()
-        try:
-            self.__shutdown = True
-            if not self.__maintask.cancelled():
-                self.__maintask.cancel()
-                await self.__maintask
-        except asyncio.CancelledError:
-            pass
         
-        self.__finishEvent.set()       
-
-    async def __run(self):
+        self.__closed = True
+        for worker in self.__workers:
+            worker.cancel()
+        
+        if self.__workers:
+            await asyncio.gather(*self.__workers, return_exceptions=True)
+        
+        self.__workers = []
+        self.__arbiter.remove(self)
+    
+    
+    def _schedule(self, runner):
+        #adds the runner to the end of the ready queue. The workers are only started on first use
+        
+        if self.__closed:
+            return
+        
+        if not self.__workers:
+            self.__workers = [asyncio.ensure_future(self.__work()) for i in range(self.__numWorkers)]
+            
+        self.__ready.put_nowait(runner)
+        
+        
+    def _activate(self, runner):
+        #a runner got work
+        self.__active.add(runner)
+        
+        
+    def _deactivate(self, runner):
+        #a runner finished all its work
+        
+        self.__active.discard(runner)
+        if self.__active or not self.__waiters:
+            return
+        
+        for waiter in self.__waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+                
+        self.__waiters = []
+        
+        
+    def _scheduleDebounced(self, runner):
+        #adds the runner to the ready queue after the debounce window passed. Returns False if there is no window
+        
+        window = self.debounceWindow()
+        if window <= 0:
+            return False
+        
+        self.Metrics.Debounced += 1
+        asyncio.get_event_loop().call_later(window, self._schedule, runner)
+        return True
+    
+    
+    def _recordRoundTrip(self, duration):
+        #updates the round trip estimate with the duration of an executed batch
+        
+        if self.__roundTrip == 0:
+            self.__roundTrip = duration
+        else:
+            self.__roundTrip = 0.8*self.__roundTrip + 0.2*duration
+        
+        
+    async def __work(self):
         
-        self.__finishEvent.set()
         while True:
+            runner = await self.__ready.get()
+            await self.__arbiter.acquire(self)
+            slot = _StepSlot(self.__arbiter, self)
+            token = _CurrentSlot.set(slot)
+            started = self.Metrics.now()
             try:
-                await self.__syncEvent.wait()
-                self.__finishEvent.clear()
-                        
-                #work the tasks synchronous
-                task = self.__tasks.pop(0)
-                while task:
-                    self.__current = task.name()
-                    try:
-                        await task.execute()
-                        
-                    except Exception as e:
-                        if self._handleError(e):
-                            # Remove all remaining tasks
-                            self.__tasks = []
-                        else:
-                            raise e
-                    
-                    if self.__tasks:
-                        task = self.__tasks.pop(0)
-                    else:
-                        task = None
-                    
-                self.__finishEvent.set()
-                self.__syncEvent.clear()
-                
+                reschedule = await runner._step()
+            
             except Exception as e:
-                self.__logger.error(f"{e}")
+                self.__logger.error(f"Unexpected exception in document scheduler: {e}")
+                reschedule = True
                 
-        if not self.__shutdown:
-            self.__logger.error(f"Main loop of sync runner closed unexpectedly: {e}")
+            finally:
+                #tasks started from the step inherit the context, they must not give away the slot afterwards
+                _CurrentSlot.reset(token)
+                if slot.Held:
+                    slot.Held = False
+                    self.__arbiter.release(self, self.Metrics.now() - started - slot.Suspended)
+                
+            if reschedule:
+                runner._reschedule()
+
+
+class _Runner(_TaskErrorHandler, _TaskBackpressure):
+    #Base class for the ordered runners. The runner holds the task queue, but does not execute it itself: this is
+    #done by the workers of a DocumentScheduler, which call _step() whenever the runner has work. If no scheduler
+    #is provided the runner creates a private one with a single worker, which behaves like a runner with its
+    #own main loop task
+    
+    def __init__(self, logger, scheduler, highWaterMark):
         
-           
-    def run(self, fnc, *args):
+        _TaskErrorHandler.__init__(self)
+        _TaskBackpressure.__init__(self, logger, highWaterMark)
+        
+        self._logger         = logger
+        self._tasks          = deque()
+        self._current        = ""
+        self.__scheduled     = False    #true if queued in the scheduler, executing or parked on a blocking task
+        self.__coalesce      = {}       #key -> queued task that can still be replaced
+        self.__queuedTotal   = 0        #number of tasks ever queued
+        self.__poppedTotal   = 0        #number of tasks ever removed from the queue
+        self.__doneTotal     = 0        #number of tasks ever finished
+        self.__doneWaiters   = []       #(count, callback) to be called when count tasks are finished
+        self.__closed        = False
+        self.__waiters       = []       #futures of waitTillCloseout calls, only created when someone waits
+        self.__barrier       = None     #EpochBarrier checked before each task
+        self.__exempt        = None     #returns True if the barrier shall be ignored
+        self.__ownsScheduler = scheduler is None
+        
+        if scheduler is None:
+            scheduler = DocumentScheduler(logger, workers=1)
+            
+        self._scheduler = scheduler
+        self._metrics   = scheduler.Metrics
+        
+        
+    async def waitTillCloseout(self, timeout = 10):
+        #Returns when all active tasks are finished. Also waits for tasks added after the call to this function
+        
+        if not self.__scheduled:
+            return
+        
+        waiter = asyncio.get_event_loop().create_future()
+        self.__waiters.append(waiter)
+        try:
+            await waitSuspended(asyncio.wait_for(waiter, timeout))
+            
+        except asyncio.TimeoutError as e:
+            remaining = self.queued()
+            self._logger.error(f"Runner closeout timed out while working on {self._current}. Remaining: \n{remaining}")
+            
+            
+    async def close(self):
+        
+        await self.waitTillCloseout()
+        self.__closed = True
+        
+        if self.__ownsScheduler:
+            await self._scheduler.close()
+            
+        #nothing will be executed anymore, do not let anyone wait for us
+        self.__setDone(self.__queuedTotal)
+        self.__finished()
+
+
+    def run(self, fnc, *args, key = None, after = None):
+        #queues the task. Returns True if the runner is congested, e.g. the queue is above the high water mark
+        #If a key is given and a task with the same key is queued but not yet started, that task is executed with
+        #the new arguments instead of queueing a new one (last write wins). Tasks without key are ordering barriers: 
+        #a task queued before them is never replaced by one queued after them.
+        #If other runners are given as "after", the task does not start before those runners finished all tasks 
+        #queued till now.
+        
+        if after:
+            after = [(runner, runner.__queuedTotal) for runner in after if runner is not self and runner.__pending()]
+        
+        if key is None:
+            self.__coalesce.clear()
+            return self._enqueue(Task(fnc, args, after = after))
         
-        self.__tasks.append(Task(fnc, args))
-        self.__syncEvent.set()
+        #the new arguments may refer to objects created since the pending task was queued, hence it is only replaced
+        #if no barrier epoch was started in between
+        pending = self.__coalesce.get(key, None)
+        if pending is not None and not pending.Started and not after and pending.Epoch == self.__epoch():
+            pending.Args = args
+            self._metrics.Coalesced += 1
+            return self._checkBackpressure(len(self._tasks))
         
+        task = Task(fnc, args, key = key, after = after)
+        self.__coalesce[key] = task
+        return self._enqueue(task)
         
+        
+    def purge(self, drop):
+        #removes all queued tasks that did not start yet and for which drop(task) is True. Blocking tasks are always
+        #kept, as other runners may wait for them. Returns the number of removed tasks
+        
+        kept = deque(task for task in self._tasks if task.Blocking or not drop(task))
+        num  = len(self._tasks) - len(kept)
+        if num == 0:
+            return 0
+        
+        self.__coalesce = {key: task for key, task in self.__coalesce.items() if task.Blocking or not drop(task)}
+        self.__poppedTotal += num
+        self._metrics.recordQueued(-num)
+        self._metrics.Cancelled += num
+        self._tasks = kept
+        self._regroup()
+        return num
+    
+    
     def queued(self):
         #returns the names of all currently queued tasks
-        return [task.name() for task in self.__tasks]
+        return [task.name() for task in self._tasks]
+    
+    
+    def setBarrier(self, barrier, exempt = None):
+        #Tasks do not start before all epochs of the barrier (see Syncer.EpochBarrier) that were started before
+        #the task was queued are finished. The barrier is ignored as long as exempt() returns True
+        
+        self.__barrier = barrier
+        self.__exempt  = exempt
+        
+        
+    def __epoch(self):
+        return self.__barrier.Epoch if self.__barrier else 0
+    
+    
+    def idle(self):
+        #true if the runner neither has queued tasks nor executes or waits for one
+        return not self.__scheduled
+    
+    
+    def metrics(self):
+        #returns the metrics of this runner. Note: if the runner uses a shared scheduler these include all its runners
+        return self._metrics.snapshot()
     
     
     def sync(self, syncer):
-        self.run(syncer.execute)
+        #syncronisation: the syncer is executed after all currently queued tasks. As syncers can block the runner
+        #till something outside happens, they are executed without occupying a scheduler worker
+        self.__coalesce.clear()
+        self._enqueue(Task(syncer.execute, (), blocking = True))
+        
+        
+    def _enqueue(self, task):
+        
+        task.Queued = self._metrics.now()
+        task.Epoch  = self.__epoch()
+        self._group(task)
+        self._metrics.recordQueued()
+        self._tasks.append(task)
+        self.__queuedTotal += 1
+        if not self.__scheduled and not self.__closed:
+            self.__scheduled = True
+            self._scheduler._activate(self)
+            if not (self._debounce() and self._scheduler._scheduleDebounced(self)):
+                self._scheduler._schedule(self)
+            
+        return self._checkBackpressure(len(self._tasks))
+        
+        
+    async def _step(self):
+        #Executes the next task or batch. Returns False if the runner was parked on a blocking task, in which
+        #case it is rescheduled when that task finishes
+        
+        if not self._tasks:
+            #all tasks were purged after the runner was scheduled
+            self.__setDone(self.__poppedTotal)
+            return True
+        
+        head = self._tasks[0]
+        if head.Epoch and self.__barrier and not (self.__exempt and self.__exempt()):
+            if self.__barrier.wait(head.Epoch, self._reschedule, self._pipelined()):
+                return False
+            
+        if head.After:
+            for runner, count in head.After:
+                if runner.__doneTotal < count:
+                    runner.__doneWaiters.append((count, self._reschedule))
+                    return False
+                
+            head.After = None
+            
+        if head.Blocking:
+            task = self._popTask()
+            self._current = task.name()
+            parked = asyncio.ensure_future(task.execute())
+            parked.add_done_callback(self.__unpark)
+            return False
+        
+        started = self._metrics.now()
+        try:
+            pending = await self._execute()
+            self._metrics.recordExecution(self._current, started)
+            
+            if asyncio.isfuture(pending):
+                #the step finishes asynchronously (e.g. a write collected with the ones of other objects): park the
+                #runner without occupying the worker
+                pending.add_done_callback(self.__unpark)
+                return False
+            
+        except Exception as e:
+            handled = await self._handleError(e)
+            self._metrics.recordError(handled)
+            if handled:
+                # Remove all remaining tasks, except the syncers
+                self._clearTasks()
+            else:
+                self._logger.error(f"Unexpected exception in runner: {e}")
+        
+        self.__setDone(self.__poppedTotal)
+        return True
+        
+        
+    async def _execute(self):
+        #executes the next task(s) from the queue, to be implemented by subclasses. May return a future if the
+        #execution is not finished yet, the next step starts when it is done
+        raise NotImplementedError()
+    
+    
+    def _debounce(self):
+        #true if the runner should wait for more tasks to arrive before executing the next step
+        return False
+    
+    
+    def _group(self, task):
+        #called for each task before it is added to the queue, after it was stamped with the barrier epoch
+        pass
+    
+    
+    def _regroup(self):
+        #called after tasks were removed from the middle of the queue
+        pass
+    
+    
+    def _pipelined(self):
+        #true if the next step only prepares writes, which are gated by the writer itself
+        return False
+    
+    
+    def _clearTasks(self):
+        #removes all queued tasks except the blocking ones, as other runners may wait for them (see purge)
+        
+        kept = deque(task for task in self._tasks if task.Blocking)
+        num  = len(self._tasks) - len(kept)
+        self._metrics.recordQueued(-num)
+        self.__poppedTotal += num
+        self._tasks = kept
+        self.__coalesce.clear()
+        self._regroup()
+        
+        
+    def _popTask(self):
+        #removes the first task from the queue, it cannot be coalesced anymore
+        
+        self.__poppedTotal += 1
+        task = self._tasks.popleft()
+        self._metrics.recordStart(task.Queued, task.Blocking)
+        if task.Key is not None and self.__coalesce.get(task.Key, None) is task:
+            del self.__coalesce[task.Key]
+            
+        return task
+    
+    
+    def _reschedule(self):
+        #called after a step finished: requeue the runner if more work is available, otherwise it becomes idle
+        
+        if self._tasks and not self.__closed:
+            if not (self._debounce() and self._scheduler._scheduleDebounced(self)):
+                self._scheduler._schedule(self)
+        else:
+            self.__finished()
+            
+            
+    def __unpark(self, parked):
+        
+        if not parked.cancelled() and parked.exception():
+            self._logger.error(f"Parked task failed: {parked.exception()}")
+            
+        self.__setDone(self.__poppedTotal)
+        self._reschedule()
+        
+        
+    def __pending(self):
+        return self.__doneTotal < self.__queuedTotal
+    
+    
+    def __setDone(self, count):
+        #marks count tasks as finished and informs everyone waiting for it
+        
+        self.__doneTotal = count
+        if not self.__doneWaiters:
+            return
+        
+        waiters = self.__doneWaiters
+        self.__doneWaiters = [waiter for waiter in waiters if waiter[0] > count]
+        for waitcount, callback in waiters:
+            if waitcount <= count:
+                callback()
+        
+        
+    def __finished(self):
+        
+        self.__scheduled = False
+        self._scheduler._deactivate(self)
+        for waiter in self.__waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+                
+        self.__waiters = []
+
+    
+class OrderedRunner(_Runner):
+    #AsyncRunner which runs task in order
+   
+    #runs all tasks synchronous
+    def __init__(self, logger, scheduler = None, highWaterMark = DefaultHighWaterMark):
+        _Runner.__init__(self, logger, scheduler, highWaterMark)
+        
+        
+    async def _execute(self):
+        
+        task = self._popTask()
+        self._current = task.name()
+        return await task.execute()
 
 
-class BatchedOrderedRunner(_TaskErrorHandler):
+class BatchedOrderedRunner(_Runner):
     #batched ordered execution of tasks
     #Normally run received a function object of an async function and its arguments.
     #The functions are than processed in order one by one (each one awaited). If functions can be batched
     #together, this can be done in the following way:
     #1. register batch handler. This is a async function which is called after all batchable functions are executed
     #2. run functions that have a batchhandler assigned. Those functions must not be awaitables, but default functions.
+    #
+    #Batches are detected incrementally when tasks are queued: consecutive tasks are grouped as long as at least one 
+    #registered batcher accepts all of them. Choosing the next batch is hence O(1), independent of the queue length.
 
     #runs all tasks synchronous and batches tasks together if possible
-    def __init__(self, logger):
+    def __init__(self, logger, scheduler = None, highWaterMark = DefaultHighWaterMark):
         
-        _TaskErrorHandler.__init__(self)
-
-        self.__logger        = logger
-        self.__tasks         = []
-        self.__syncEvent     = asyncio.Event() 
-        self.__finishEvent   = asyncio.Event()
-        self.__batcher       = []
-        self.__shutdown      = False
-
-        self.__maintask = asyncio.ensure_future(self.__run())
+        _Runner.__init__(self, logger, scheduler, highWaterMark)
+        self.__batcher    = []
+        self.__accepting  = {}      #task name -> batchers that accept it, in registration order
+        self.__groups     = deque() #[batchers, count, epoch] for consecutive tasks in the queue
 
 
     def registerBatcher(self, batcher):        
         self.__batcher.append(batcher)
+        self.__accepting = {}
 
 
-    async def waitTillCloseout(self, timeout = 10):     
-        try:
-            await asyncio.wait_for(self.__finishEvent.wait(), timeout)
-            
-        except asyncio.TimeoutError as e:
-            remaining = self.queued()
-            self.__logger.error(f"Runner closeout timed out while working ({not self.__maintask.done()}). Remaining: \n{remaining}")     
-
-
-    async def close(self):
-               
-        await self.waitTillCloseout()
-        try:
-            self.__shutdown = True
-            if not self.__maintask.cancelled():
-                self.__maintask.cancel()
-                await self.__maintask
-        except asyncio.CancelledError:
-            pass
+    def _group(self, task):
+        #adds the task to the batch groups
         
-        self.__finishEvent.set()
+        if task.Blocking:
+            batchers = ()
+        else:
+            batchers = self.__accepting.get(task.Name, None)
+            if batchers is None:
+                batchers = tuple(b for b in self.__batcher if b.accepts(task.Name))
+                self.__accepting[task.Name] = batchers
         
-
-    async def __run(self):
-                  
-        #initially we have no work
-        self.__finishEvent.set()
+        #extend the last group if any of its batchers also handles the new task. Tasks that need to wait for 
+        #other runners or for a newer barrier epoch always start a new group, as a group waits only for the tickets 
+        #and the epoch of its first task
+        if batchers and self.__groups and not task.After and self.__groups[-1][2] == task.Epoch:
+            group = self.__groups[-1]
+            if group[0] is batchers:
+                group[1] += 1
+                return
             
-        while True:
+            common = tuple(b for b in group[0] if b in batchers)
+            if common:
+                group[0] = common
+                group[1] += 1
+                return
             
-            try:
-                #wait till new tasks are given.
-                await self.__syncEvent.wait()
-                
-                #inform that we are working
-                self.__finishEvent.clear()            
-                    
-                #work the tasks in order
-                while self.__tasks:
-                                       
-                    try:
-                        executed  = await Batcher.executeBatchersOnTasks(self.__batcher, self.__tasks, )
-                        if executed > 0:
-                            self.__tasks = self.__tasks[executed:]
-                        else:                       
-                            #not batchable, execute normal operation
-                            await self.__tasks.pop(0).execute()
-
-                    except Exception as e:
-                        
-                        if self._handleError(e):
-                            # Remove all tasks now
-                            self.__tasks = []
-                        else:
-                            raise e
-                
-                self.__finishEvent.set()
-                self.__syncEvent.clear()
-
-
-            except Exception as e:
-                self.logger.error(f"Unexpected exception in BatchedOrderedRunner: {e}")
-                
-        if not self.__shutdown:            
-            self.logger.error(f"Unexpected shutdown in BatchedOrderedRunner: {e}")
+        self.__groups.append([batchers, 1, task.Epoch])
+    
+    
+    def _popTask(self):
         
-           
-    def run(self, fnc, *args):
+        group = self.__groups[0]
+        group[1] -= 1
+        if group[1] == 0:
+            self.__groups.popleft()
+            
+        return _Runner._popTask(self)
+    
+    
+    def _regroup(self):
         
-        self.__tasks.append(Task(fnc, args))
-        self.__syncEvent.set()
+        self.__groups.clear()
+        for task in self._tasks:
+            self._group(task)
         
-    def queued(self):
-        #returns the names of all currently queued tasks
-        return [task.name() for task in self.__tasks]
         
-    def sync(self, syncer):
-        self.run(syncer.execute)
+    def _debounce(self):
+        #only worth waiting if new tasks can still be added to the next batch, e.g. it is the last group
+        return len(self.__groups) == 1 and bool(self.__groups[0][0])
+    
+    
+    def _pipelined(self):
         
+        batchers = self.__groups[0][0]
+        return bool(batchers) and batchers[0].Pipelined
+
 
-class DocumentBatchedOrderedRunner():
+    async def _execute(self):
+        
+        batchers, count = self.__groups[0][:2]
+        if batchers:
+            #remove the whole group before executing, new tasks must not be added to it anymore
+            tasks = [self._popTask() for i in range(count)]
+            self._current = batchers[0].Name
+            started = self._metrics.now()
+            pending = await batchers[0].execute(tasks, self._metrics)
+            if not asyncio.isfuture(pending):
+                self._scheduler._recordRoundTrip(self._metrics.now() - started)
+            else:
+                pending.add_done_callback(lambda f: self._scheduler._recordRoundTrip(self._metrics.now() - started))
+                
+            return pending
+            
+        else:                       
+            #not batchable, execute normal operation
+            task = self._popTask()
+            self._current = task.name()
+            return await task.execute()
+        
+
+class DocumentBatchedOrderedRunner(_TaskErrorHandler):
     #A Async runner that synchronizes over the whole document, and has the same API as the BatchedOrderedRunner to be 
     #compatible replacement
     
     def __init__(self, runner):
+        _TaskErrorHandler.__init__(self)
         self.__docRunner = runner
         self.__batchHandler = {}
         
@@ -290,27 +916,67 @@ class DocumentBatchedOrderedRunner():
         self.__batchHandler[fncName] = batchFnc;
         
     
-    def run(self, fnc, *args):
+    def registerBatcher(self, batcher):
+        #Batchers cannot be used on the shared document runner, hence tasks of the batcher are directly
+        #followed by its handler. Combined batchers do not add any handler.
+        if hasattr(batcher, "Handler"):
+            self.registerBatchHandler(batcher.Name, batcher.Handler)
+        
+    
+    def run(self, fnc, *args, key = None, after = None):
+        #Note: "after" is ignored, all tasks of the document are executed in order anyway
         
         #check if this function needs to be handled by batch function, and 
-        #build a wrapper if so
-        if fnc.__name__ in self.__batchHandler:
-            
-            handler = self.__batchHandler[fnc.__name__ ]
+        #build a wrapper if so. Errors are handled by our own handlers, not the ones of the document runner
+        name = taskName(fnc)
+        handler = self.__batchHandler.get(name, None)
             
-            async def wrapper(*args):
-                fnc(*args)
-                await handler()
+        async def wrapper(*args):
+            try:
+                if asyncio.iscoroutinefunction(fnc):
+                    await fnc(*args)
+                else:
+                    pending = fnc(*args)
+                    if asyncio.isfuture(pending):
+                        await pending
+                    
+                if handler:
+                    pending = await handler()
+                    if pending is not None:
+                        await pending
+                    
+            except Exception as e:
+                if not await self._handleError(e):
+                    raise e
+        
+        wrapper.__qualname__ = name
+        wrapper.Owner = self
+        return self.__docRunner.run(wrapper, *args, key=key)
                 
-            self.__docRunner.run(wrapper, *args)
-            
-        else:
-            self.__docRunner.run(fnc, *args)
+                
+    def purge(self, drop):
+        #only purges our own tasks, the document runner holds the ones of all objects
+        return self.__docRunner.purge(lambda task: getattr(task.Func, "Owner", None) is self and drop(task))
                 
                 
     def queued(self):
         #returns the names of all currently queued tasks
         return self.__docRunner.queued()
+    
+    def metrics(self):
+        return self.__docRunner.metrics()
+    
+    @property
+    def HighWaterMark(self):
+        #backpressure is reported by the shared document runner
+        return self.__docRunner.HighWaterMark
+    
+    @HighWaterMark.setter
+    def HighWaterMark(self, mark):
+        self.__docRunner.HighWaterMark = mark
+    
+    def idle(self):
+        return self.__docRunner.idle()
         
     def sync(self, syncer):
         #syncronisation: provide a syncer. The runner calls done() when all currently 
@@ -1,32 +1,10 @@
 
-#Batcher are used together with Batched Asyncrunner. They scan over the existing tasks of the runner and 
-#batch them together when possible. For example a single "changeProperty" task can be batched with others into
-#a "multiChangeProperty" call, hence reducing the amount of OCP node calls required.
-
-async def executeBatchersOnTasks(batchers, tasks):
-    #Runs the batcher with the largest number of batchable tasks on the tasklist, and returns how many task
-    #have been executed
-    
-    #start all batchers
-    for batcher in batchers:
-        batcher.startBatching()                        
-        for task in tasks:
-            if not batcher.batch(task):
-                break
-            
-        batcher.doneBatching()
-    
-    #and now use the one with the most batched tasks
-    num = [batcher.numBatched() for batcher in batchers]
-    maxBatched = max(num)
-                    
-    if maxBatched > 0:
-        
-        #run the lucky batcher
-        idx = num.index(maxBatched)                              
-        await batchers[idx].execute()
-                    
-    return maxBatched
+#Batcher are used together with Batched Asyncrunner. The runner groups consecutive tasks that can be handled by the 
+#same batcher already when they are queued, and hands each group to the batcher for execution. For example a single 
+#"changeProperty" task can be batched with others into a "multiChangeProperty" call, hence reducing the amount of OCP 
+#node calls required.
+#A group always uses the first registered batcher that accepts all its tasks. As groups are extended as long as any 
+#batcher accepts the new task, this is the batcher that can handle the largest number of tasks from the queue start.
 
 
 class EquallityBatcher():
@@ -34,45 +12,34 @@ class EquallityBatcher():
     #tasks and afterwards the handler. The principal is that the batched themself do not execute an expensive operation
     #but fill some kind of cache, and the handler afterwards uses this cache to start optimized execution on it
     
-    def __init__(self, taskName, handler):
+    def __init__(self, taskName, handler, pipelined = False):
         self.__func = taskName
         self.__handler = handler
-        self.__tasks = []
         
         self.Name = taskName
-        
-    def startBatching(self):
-        self.__tasks = []
+        self.Handler = handler
+        self.Pipelined = pipelined  #true if the handler only prepares and queues the writes (see OCPDocumentWriter)
         
         
-    def batch(self, task):
+    def accepts(self, name):
+        return name == self.__func
         
-        if task.name() == self.__func:
-            self.__tasks.append(task)
-            return True
         
-        return False
+    async def execute(self, tasks, metrics = None):
         
-        
-    def doneBatching(self):
-        pass
-        
-        
-    async def execute(self):
+        if metrics is not None:
+            metrics.recordBatch(self.Name, len(tasks))
         
         #first execute all batched functions
-        for task in self.__tasks:
+        for task in tasks:
             await task.execute()
         
-        #not execute the batchhandler
-        await self.__handler()
+        #not execute the batchhandler. It may return a future if it finishes asynchronously
+        return await self.__handler()
         
     
-    def numBatched(self):
-        return len(self.__tasks)
-    
     def copy(self):
-        return EquallityBatcher(self.__func, self.__handler)
+        return EquallityBatcher(self.__func, self.__handler, self.Pipelined)
     
 
 class MultiBatcher():
@@ -84,34 +51,34 @@ class MultiBatcher():
         
         self.__batchers = batchers
         self.Name = f"MultiBatcher"
+        self.Pipelined = all(batcher.Pipelined for batcher in batchers)
     
-    def startBatching(self):
-        for batcher in self.__batchers:
-            batcher.startBatching()
-
-        
-    def batch(self, task):
+    
+    def accepts(self, name):
         
         for batcher in self.__batchers:
-            if batcher.batch(task):
+            if batcher.accepts(name):
                 return True
         
         return False
     
     
-    def doneBatching(self):
-        for batcher in self.__batchers:
-            batcher.doneBatching()
-
-        
-    async def execute(self):
+    async def execute(self, tasks, metrics = None):
         
-        for batcher in self.__batchers:
-            await batcher.execute()        
-    
-    
-    def numBatched(self):
-        vals  = [b.numBatched() for b in self.__batchers]
-        return sum(vals)
-    
-
+        #sort the tasks to the first batcher accepting them, keeping their order
+        batched = [[] for batcher in self.__batchers]
+        for task in tasks:
+            for idx, batcher in enumerate(self.__batchers):
+                if batcher.accepts(task.name()):
+                    batched[idx].append(task)
+                    break
+        
+        #only the last batcher may finish asynchronously, the others need to be done before the next one starts
+        result = None
+        for batcher, tasks in zip(self.__batchers, batched):
+            if tasks:
+                if result is not None:
+                    await result
+                result = await batcher.execute(tasks, metrics)
+                
+        return result
@@ -39,6 +39,12 @@ class DataService():
         self.__data[key] = data
         self.__keyCntr += 1
         return key
+    
+    def addDatas(self, datas):
+        keys = list(range(self.__keyCntr, self.__keyCntr + len(datas)))
+        self.__data.update(zip(keys, datas))
+        self.__keyCntr += len(datas)
+        return keys
         
     def getData(self, key):
         if key not in self.__data:
@@ -0,0 +1,168 @@
+# ************************************************************************
+# *   Copyright (c) Stefan Troeger (stefantroeger@gmx.net) 2021          *
+# *                                                                      *
+# *   This library is free software; you can redistribute it and/or      *
+# *   modify it under the terms of the GNU Library General Public        *
+# *   License as published by the Free Software Foundation; either       *
+# *   version 2 of the License, or (at your option) any later version.   *
+# *                                                                      *
+# *   This library  is distributed in the hope that it will be useful,   *
+# *   but WITHOUT ANY WARRANTY; without even the implied warranty of     *
+# *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the      *
+# *   GNU Library General Public License for more details.               *
+# *                                                                      *
+# *   You should have received a copy of the GNU Library General Public  *
+# *   License along with this library; see the file COPYING.LIB. If not, *
+# *   write to the Free Software Foundation, Inc., 59 Temple Place,      *
+# *   Suite 330, Boston, MA  02111-1307, USA                             *
+# ************************************************************************
+
+# Instrumentation of the async runners. All recording is done with a few integer operations and dict lookups,
+# so that the metrics can stay enabled in production. Metrics are collected per DocumentScheduler (or standalone
+# runner) and not per object, to not let memory scale with the document size.
+
+import time
+
+class Histogram():
+    # Histogram with fixed logarithmic buckets: bucket i counts values below 2^i (in the given unit, e.g. ms)
+
+    def __init__(self, scale = 1):
+        self.__scale   = scale
+        self.__buckets = []
+        self.Count     = 0
+        self.Sum       = 0
+        self.Max       = 0
+
+    def record(self, value):
+
+        value = value*self.__scale
+        self.Count += 1
+        self.Sum   += value
+        if value > self.Max:
+            self.Max = value
+
+        idx = int(value).bit_length()
+        if idx >= len(self.__buckets):
+            self.__buckets.extend([0]*(idx - len(self.__buckets) + 1))
+        self.__buckets[idx] += 1
+
+    def snapshot(self):
+
+        mean = self.Sum/self.Count if self.Count else 0
+        buckets = {f"<{2**i}": count for i, count in enumerate(self.__buckets) if count}
+        return {"count": self.Count, "mean": mean, "max": self.Max, "buckets": buckets}
+
+
+class RunnerMetrics():
+    # Counters and histograms for all runners executed by a scheduler
+    # Times are recorded in seconds and reported in milliseconds
+
+    def __init__(self):
+        self.Queued         = 0     #currently queued tasks
+        self.MaxQueued      = 0
+        self.Executed       = 0     #tasks started
+        self.Work           = 0     #tasks started that are no syncers
+        self.Coalesced      = 0     #tasks merged into an already queued one
+        self.Cancelled      = 0     #tasks removed from the queue without execution
+        self.Debounced      = 0     #runner starts delayed to accumulate a batch
+        self.Errors         = 0     #failed tasks
+        self.HandledErrors  = 0     #failed tasks for which an error handler was invoked
+        self.StartLatency   = Histogram(1000)
+        self.Execution      = {}    #task or batcher name -> Histogram
+        self.Batches        = {}    #batcher name -> Histogram of batch sizes
+
+    def now(self):
+        return time.monotonic()
+
+    def recordQueued(self, num = 1):
+        self.Queued += num
+        if self.Queued > self.MaxQueued:
+            self.MaxQueued = self.Queued
+
+    def recordStart(self, queuedAt, blocking = False):
+        self.Queued   -= 1
+        self.Executed += 1
+        if not blocking:
+            self.Work += 1
+        self.StartLatency.record(time.monotonic() - queuedAt)
+
+    def recordExecution(self, name, startedAt):
+
+        hist = self.Execution.get(name, None)
+        if hist is None:
+            hist = Histogram(1000)
+            self.Execution[name] = hist
+
+        hist.record(time.monotonic() - startedAt)
+
+    def recordBatch(self, name, size):
+
+        hist = self.Batches.get(name, None)
+        if hist is None:
+            hist = Histogram()
+            self.Batches[name] = hist
+
+        hist.record(size)
+
+    def recordError(self, handled):
+        self.Errors += 1
+        if handled:
+            self.HandledErrors += 1
+
+    def snapshot(self):
+        # returns all metrics as dict of plain python types
+
+        return {"queued": self.Queued,
+                "maxQueued": self.MaxQueued,
+                "executed": self.Executed,
+                "work": self.Work,
+                "coalesced": self.Coalesced,
+                "cancelled": self.Cancelled,
+                "debounced": self.Debounced,
+                "errors": self.Errors,
+                "handledErrors": self.HandledErrors,
+                "startLatency": self.StartLatency.snapshot(),
+                "execution": {name: hist.snapshot() for name, hist in self.Execution.items()},
+                "batches": {name: hist.snapshot() for name, hist in self.Batches.items()}}
+
+
+class CacheMetrics():
+    # Counters for a lookup cache. SavedBytes sums the payload sizes that did not need to be transferred due to hits
+
+    def __init__(self):
+        self.Hits       = 0
+        self.Misses     = 0
+        self.Evictions  = 0
+        self.SavedBytes = 0
+
+    def recordHit(self, size):
+        self.Hits       += 1
+        self.SavedBytes += size
+
+    def recordMiss(self):
+        self.Misses += 1
+
+    def snapshot(self):
+
+        total = self.Hits + self.Misses
+        return {"hits": self.Hits,
+                "misses": self.Misses,
+                "hitRate": self.Hits/total if total else 0,
+                "evictions": self.Evictions,
+                "savedBytes": self.SavedBytes}
+
+
+class WriteMetrics():
+    # Counters for the property values handed to the writers. Suppressed values are identical to the last ones
+    # written or received and are not sent to the node. Failed counts the object creations and value writes the
+    # node rejected or that raised, as the writers only log those errors
+
+    def __init__(self):
+        self.Written    = 0
+        self.Suppressed = 0
+        self.Failed     = 0
+
+    def snapshot(self):
+        return {"written": self.Written,
+                "suppressed": self.Suppressed,
+                "failed": self.Failed}
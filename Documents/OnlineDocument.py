@@ -17,15 +17,108 @@
 # *   Suite 330, Boston, MA  02111-1307, USA                             *
 # ************************************************************************
 
-import asyncio, logging, os, traceback
+import asyncio, logging, traceback
 import Documents.Property   as Property
 import Documents.Syncer     as Syncer
 import Documents.Observer   as Observer
 from Documents.OnlineObserver   import OnlineObserver
 from Documents.OnlineObject     import OnlineObject, OnlineViewProvider
-from Documents.AsyncRunner      import DocumentRunner
+from Documents.Writer           import OCPDocumentWriter
+from Documents.AsyncRunner      import DocumentRunner, DocumentScheduler, SyncMode, syncModeFromEnvironment, autoSyncFromEnvironment
+from Documents.AsyncRunner      import DefaultHighWaterMark
 
 from autobahn.wamp.exception    import ApplicationError
+from PySide                     import QtCore
+
+
+class DocumentMetrics(QtCore.QObject):
+    # Qt access to the runner metrics of an OnlineDocument, e.g. for the collaboration panel. Metrics change with
+    # every task, hence no signal is emitted on each change: call update() to notify about new values
+    
+    def __init__(self, onlinedoc):
+        QtCore.QObject.__init__(self)
+        self.__onlinedoc = onlinedoc
+        
+    @QtCore.Slot()
+    def update(self):
+        self.metricsChanged.emit()
+        
+    def __getMetrics(self):
+        return self.__onlinedoc.metrics()
+    
+    metricsChanged = QtCore.Signal()
+    metrics        = QtCore.Property("QVariantMap", __getMetrics, notify=metricsChanged)
+
+
+class AutoSyncPolicy():
+    # Chooses the sync mode of a document from the behaviour of its outgoing runners. Per object runners are 
+    # faster, but changes of different objects may reach the node in a conflicting order. If too many tasks or writes 
+    # fail the document falls back to Document-Sync. It returns to per object runners if no task failed for a while and
+    # tasks need to wait long in the single document queue, e.g. the document is busy.
+    
+    def __init__(self, onlinedoc, interval = 10, maxErrorRate = 0.02, maxLatency = 100, calmIntervals = 6):
+        self.__onlinedoc    = onlinedoc
+        self.__interval     = interval          #seconds between evaluations
+        self.__maxErrorRate = maxErrorRate      #failed per executed tasks above which Document-Sync is used
+        self.__maxLatency   = maxLatency        #mean start latency in ms above which Document-Sync is left
+        self.__calm         = calmIntervals     #evaluations without errors required to leave Document-Sync
+        self.__calmCount    = 0
+        self.__last         = None              #metric totals at the last evaluation
+        self.__fastMode     = onlinedoc.syncMode if onlinedoc.syncMode != SyncMode.Document else SyncMode.Object
+        self.__task         = None
+        
+    def start(self):
+        if not self.__task:
+            self.__task = asyncio.ensure_future(self.__run())
+    
+    def stop(self):
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+        
+    def evaluate(self):
+        # returns the SyncMode to switch to, or None if the current one shall be kept
+        
+        metrics = self.__onlinedoc.metrics()
+        sender  = metrics["sender"]
+        latency = sender["startLatency"]
+        #the writers log node errors instead of raising, hence their failures are counted in addition to task errors
+        errors  = sender["errors"] + metrics["writes"]["failed"]
+        current = (sender["executed"], errors, latency["count"], latency["mean"]*latency["count"])
+        last, self.__last = self.__last, current
+        if last is None:
+            return None
+        
+        executed, errors, count, latencySum = [c - l for c, l in zip(current, last)]
+        if executed <= 0 or errors < 0:
+            #no work done or the runners were replaced
+            return None
+        
+        mode = self.__onlinedoc.syncMode
+        if errors / executed > self.__maxErrorRate:
+            self.__calmCount = 0
+            return SyncMode.Document if mode != SyncMode.Document else None
+        
+        self.__calmCount = self.__calmCount + 1 if errors == 0 else 0
+        if mode == SyncMode.Document and self.__calmCount >= self.__calm and count > 0 and latencySum/count > self.__maxLatency:
+            return self.__fastMode
+        
+        return None
+        
+    async def __run(self):
+        
+        while True:
+            await asyncio.sleep(self.__interval)
+            try:
+                mode = self.evaluate()
+                if mode:
+                    await self.__onlinedoc._switchSyncMode(mode)
+                    self.__last = None
+                    self.__calmCount = 0
+                    
+            except Exception as e:
+                self.__onlinedoc.logger.error(f"Automatic sync mode selection failed: {e}")
+
 
 class OnlineDocument():
     ''' Describing a FreeCAD document in the OCP framework. Properties can be changed or objects added/removed 
@@ -39,25 +132,41 @@ class OnlineDocument():
         self.connection = connection 
         self.objIds = {}
         self.data = dataservice
+        self.logger = logging.getLogger("Document " + id[-5:])
+        self.scheduler = DocumentScheduler(self.logger) #drains the outgoing runners of all objects
+        self.scheduler.setDebounce()                    #accumulate bursts of property changes into single batches
+        self.scheduler.Interactive = True               #outgoing changes are done by the user, prefer them
+        self.writer = OCPDocumentWriter(self, self.logger) #writes the data of many objects in single calls
+        self.barrier = Syncer.EpochBarrier() #holds back new tasks during object creations and transaction closes
+        self.__closedAt = -1                 #executed outgoing non-syncer tasks at the last close
+        self.highWaterMark = DefaultHighWaterMark #queued outgoing tasks of an object above which it reports backpressure
         self.onlineObs = OnlineObserver(self)
         self.objects = {}
         self.viewproviders = {}
-        self.logger = logging.getLogger("Document " + id[-5:])
         self.sync = None        
-        self.synced = os.getenv('FC_OCP_SYNC_MODE', "0") == "1"
+        self.qmetrics = DocumentMetrics(self)
+        self.syncMode = syncModeFromEnvironment()
+        self.synced = self.syncMode == SyncMode.Document
+        self.autoSync = AutoSyncPolicy(self) if autoSyncFromEnvironment() else None
+        self.__switchLock = asyncio.Lock()
             
         #Online documents cannot use the FreeCAD Transaction framework
         doc.UndoMode = 0
         
         self.logger.debug("Created")
-        if self.synced:
-            self.logger.info('Use non-default sync mode "Document-Sync"')
+        if self.syncMode != SyncMode.Object:
+            self.logger.info(f'Use non-default sync mode "{self.syncMode.name}-Sync"')
  
     async def setup(self):
         await self.onlineObs.setup()
+        if self.autoSync:
+            self.autoSync.start()
  
     async def close(self):
         # we close the online doc. That means closing the observer and all objects/viewproviders
+        if self.autoSync:
+            self.autoSync.stop()
+            
         tasks = []
         tasks.append(self.onlineObs.close())
         
@@ -70,6 +179,8 @@ class OnlineDocument():
         if tasks:
             await asyncio.gather(*tasks)
             
+        await self.scheduler.close()
+            
         self.objects = []
         self.viewproviders = []
   
@@ -89,26 +200,28 @@ class OnlineDocument():
         oobj = OnlineObject(obj, self)
         self.objects[obj.Name] = oobj
         
-        if not self.synced:
-            #create the syncer that blocks all runners till this object is created. This is required to ensure no property access the object
-            #before its creation
-            block = Syncer.BlockSyncer()
-            for entry in self.objects.values():
-                if not entry.isSettingUp():
-                    entry.synchronize(block)
+        if self.syncMode == SyncMode.Object:
+            #start a creation on the document barrier: tasks queued in other runners from now on wait till this object 
+            #is created. This is required to ensure no property access the object before its creation
+            creation = self.barrier.begin()
                     
             #we need to block till the last document recompute is done, to ensure that we are not part of that recompute cycle
             #Note:  Do not use full syncer, as this includes an AcknowledgeSyncer which is setup for the amount of objects.
             #       Adding it to the new object adds an additional Acknowledge, which may lead to the fact that the recompute happens
             #       before all other runners are done
+            if self.sync:
+                oobj.setup(self.sync.Block, creation)
+            else:
+                oobj.setup(creation=creation)
+            
+        elif self.syncMode == SyncMode.Dependency:
+            #no need to block the other objects: the ones linking to the new object wait for its runner, as it
+            #is part of their outlist. Only the last document recompute needs to be finished
             if self.sync:
                 oobj.setup(self.sync.Block)
             else:
                 oobj.setup()
             
-            #release all other online objects after setup finished
-            oobj.synchronize(Syncer.RestartBlockSyncer(block))
-            
         else:
             oobj.setup()
      
@@ -121,24 +234,46 @@ class OnlineDocument():
         if not obj.Name in self.objects:
             self.logger.error(f"Should remove object {obj.Name} but is not part of online document")
         
-        #ensure all other objects are finished before we remove, as it could be that one of those objects has a property change that refers to the object to be removed
-        ackno = Syncer.AcknowledgeSyncer(len(self.objects)-1)
-        for name, entry in self.objects.items():
-            if name != obj.Name:
-                entry.synchronize(ackno)
-        
-        #remove the async runner for that object after all other current objects are done
+        #ensure all objects linking to the removed one are finished before we remove, as it could be that one of those 
+        #objects has a property change that refers to the object to be removed. Objects without pending work are skipped
         oobj = self.objects[obj.Name]
         del(self.objects[obj.Name])
-        oobj.synchronize(Syncer.WaitAcknowledgeSyncer(ackno))
+        
+        linking = self.__linkingObjects(obj)
+        if linking is None:
+            #link data unknown: wait for all objects
+            linking = self.objects.values()
+            
+        linking = [entry for entry in linking if entry.hasPendingWork()]
+        if linking:
+            ackno = Syncer.AcknowledgeSyncer(len(linking))
+            for entry in linking:
+                entry.synchronize(ackno)
+        
+            #remove the async runner for that object after the linking objects are done
+            oobj.synchronize(Syncer.WaitAcknowledgeSyncer(ackno))
+            
         oobj.remove()
         
         #as well as the online observer one
         asyncio.ensure_future(self.onlineObs.closeRunner(obj.Name))
         
         
+    def __linkingObjects(self, obj):
+        #returns the online objects that link to obj, or None if this cannot be determined
+        
+        try:
+            names = set(o.Name for o in obj.InList)
+        except Exception:
+            return None
+        
+        #links could have been removed already, but the changes referring to obj may still be queued
+        return [entry for name, entry in self.objects.items() if name in names or obj.Name in entry.outlist]
+        
+        
     def changeObject(self, obj, prop):
-               
+        #returns True if the runner of the object reports backpressure
+        
         if self.shouldExcludeTypeId(obj.TypeId):
             return
         
@@ -151,7 +286,7 @@ class OnlineDocument():
                 return
         
         oobj = self.objects[obj.Name]
-        oobj.changeProperty(prop)
+        return oobj.changeProperty(prop)
     
     
     def changePropertyStatus(self, obj, prop):
@@ -255,6 +390,7 @@ class OnlineDocument():
         
         
     def changeViewProvider(self, vp, prop):
+        #returns True if the runner of the viewprovider reports backpressure
         
         if self.shouldExcludeTypeId(vp.Object.TypeId):
             return
@@ -264,7 +400,7 @@ class OnlineDocument():
             return
         
         ovp = self.viewproviders[vp.Object.Name]
-        ovp.changeProperty(prop)
+        return ovp.changeProperty(prop)
     
     
     def changeViewProviderPropertyStatus(self, vp, prop):
@@ -326,43 +462,155 @@ class OnlineDocument():
         # - we need to wait till all online objects finished the changes, they have till now
         # - we need to make sure no online object processes any new changes before the transaction is closed
                
-        #sync all document objects! (not viewproviders, those are not transactioned)
         if not self.synced:
-            self.sync = Syncer.AcknowledgeBlockSyncer(len(self.objects))
-            for obj in self.objects.values():
-                obj.synchronize(self.sync)
-                
-            asyncio.ensure_future(self.__recomputeDocument(self.sync))
+            #nothing to close if no task was executed since the last close. Syncers are not counted, the ones
+            #queued by the last close itself do not change anything
+            work = self.scheduler.Metrics.Work
+            if work == self.__closedAt and self.scheduler.idle():
+                return
+            
+            self.__closedAt = work
+            
+            #sync the document objects with pending work (not viewproviders, those are not transactioned). Idle 
+            #objects can be ignored, the barrier epoch holds back everything queued from now on till the close
+            busy = [obj for obj in self.objects.values() if obj.hasPendingWork()]
+            self.sync = Syncer.AcknowledgeBlockSyncer(len(busy))
+            for obj in busy:
+                obj.synchronize(self.sync.Acknowledge)
+            
+            #start the epoch after the acknowledges were queued, they must not wait for it
+            closing = self.barrier.begin()
+            asyncio.ensure_future(self.__recomputeDocument(self.sync, closing))
         
         else:
             runner = DocumentRunner.getSenderRunner(self.id, self.logger)
-            runner.run(self.__recomputeDocument(self.sync))
+            runner.run(self.__recomputeDocument, None, None)
             
         
         
-    async def __recomputeDocument(self, sync):
+    async def __recomputeDocument(self, sync, closing):
         
         #wait till all objects have done their work
         if sync:
             await sync.wait()
         
-        #close the transaction
+        #from now on all writes belong to the next transaction. Runners can already prepare their property changes, 
+        #the writer holds them back till the transaction is closed
+        if closing:
+            self.writer.hold()
+            closing.soften()
+        
+        #close the transaction. Work was done since the last close, hence it normally is open: only check that
+        #if closing fails
         try:     
             self.logger.debug("Close transaction")
-            uri = f"ocp.documents.{self.id}.content.Transaction.IsOpen"
-            if await self.connection.api.call(uri):
-                uri = f"ocp.documents.{self.id}.content.Transaction.Close"
-                await self.connection.api.call(uri)
+            uri = f"ocp.documents.{self.id}.content.Transaction.Close"
+            await self.connection.api.call(uri)
 
         except Exception as e:
-            self.logger.error(f"Closing transaction failed: {e}")
+            try:
+                uri = f"ocp.documents.{self.id}.content.Transaction.IsOpen"
+                isOpen = await self.connection.api.call(uri)
+            except Exception:
+                isOpen = True
+                
+            if isOpen:
+                self.logger.error(f"Closing transaction failed: {e}")
             
         finally:
+            if closing:
+                self.writer.release()
+                closing.finish()
+                
             if sync:
                 sync.restart()
                 self.sync = None
 
 
+    async def setSyncMode(self, mode):
+        # Switches the SyncMode while the document is shared. Disables the automatic mode selection
+        
+        self.setAutoSyncMode(False)
+        await self._switchSyncMode(mode)
+        
+    def setAutoSyncMode(self, enabled):
+        # Enables or disables the automatic choice of the SyncMode (see AutoSyncPolicy)
+        
+        if enabled and not self.autoSync:
+            self.autoSync = AutoSyncPolicy(self)
+            self.autoSync.start()
+            
+        elif not enabled and self.autoSync:
+            self.autoSync.stop()
+            self.autoSync = None
+        
+    async def _switchSyncMode(self, mode):
+        
+        async with self.__switchLock:
+            if mode == self.syncMode:
+                return
+            
+            self.logger.info(f'Switch to sync mode "{mode.name}-Sync"')
+            
+            #let the runners finish their current work
+            await self.waitTillCloseout()
+            
+            if SyncMode.Document not in (mode, self.syncMode):
+                #per object runners in both modes, only the ordering of new tasks changes
+                self.syncMode = mode
+                return
+            
+            #replace all runners at once. The new ones wait till the old ones are closed, to keep the order of tasks
+            block = Syncer.BlockSyncer()
+            wasSynced = self.synced
+            self.syncMode = mode
+            self.synced = mode == SyncMode.Document
+            
+            old  = [obj._switchRunner(block) for obj in self.objects.values()]
+            old += [vp._switchRunner(block) for vp in self.viewproviders.values()]
+            try:
+                #the old document runner must stay open, it is shared by the whole document
+                tasks = [runner.close() for runner in old if runner and not wasSynced]
+                tasks.append(self.onlineObs.switchSyncMode(block))
+                await asyncio.gather(*tasks)
+                
+            finally:
+                block.restart()
+        
+    def setDebounce(self, factor, maxLatency):
+        # Configures how long outgoing batchable changes are accumulated: factor times the node round trip time,
+        # but never longer than maxLatency seconds. Factor 0 disables the accumulation
+        self.scheduler.setDebounce(factor, maxLatency)
+        
+    def setHighWaterMark(self, mark):
+        # Sets the amount of queued outgoing tasks of an object above which its runner reports backpressure. 
+        # 0 disables the reporting
+        
+        self.highWaterMark = mark
+        if self.synced:
+            DocumentRunner.getSenderRunner(self.id, self.logger).HighWaterMark = mark
+            
+        for entry in list(self.objects.values()) + list(self.viewproviders.values()):
+            entry._runner.HighWaterMark = mark
+        
+    def metrics(self):
+        # returns the runner metrics of this document, separated into outgoing and incoming changes, and the metrics
+        # of the writer and its binary upload cache
+        
+        if self.synced:
+            return {"sender":   DocumentRunner.getSenderRunner(self.id, self.logger).metrics(),
+                    "receiver": DocumentRunner.getReceiverRunner(self.id, self.logger).metrics(),
+                    "writes":   self.writer.Metrics.snapshot(),
+                    "cids":     self.writer.cids.Metrics.snapshot()}
+        
+        return {"sender":   self.scheduler.Metrics.snapshot(),
+                "receiver": self.onlineObs.scheduler.Metrics.snapshot(),
+                "share":    {"sender":   self.scheduler.share(),
+                             "receiver": self.onlineObs.scheduler.share()},
+                "writes":   self.writer.Metrics.snapshot(),
+                "cids":     self.writer.cids.Metrics.snapshot()}
+    
+    
     async def _docPrints(self):
         uri = f"ocp.documents.{self.id}.prints"
         vals = await self.connection.api.call(uri)
@@ -465,6 +713,20 @@ class OnlineDocument():
     async def waitTillCloseout(self, timeout = 10):
         #wait till all current async tasks are finished. Note that it also wait for task added during the wait period.
         #throws an error on timeout.
+        
+        if not self.synced:
+            #all runners are drained by the two schedulers, which track their outstanding work. As the runners of 
+            #one may queue work for the other (e.g. setup of new objects), we wait till both are idle at once
+            loop = asyncio.get_event_loop()
+            end  = loop.time() + timeout
+            while not (self.scheduler.idle() and self.onlineObs.scheduler.idle()):
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    return
+                
+                await asyncio.gather(self.scheduler.waitTillCloseout(remaining), 
+                                     self.onlineObs.waitTillCloseout(remaining))
+            return
           
         coros = []
         for obj in list(self.objects.values()):
@@ -23,11 +23,11 @@
 
 
 import FreeCAD
-import asyncio, logging, os, traceback
+import asyncio, logging, traceback
 import Documents.Batcher  as Batcher
 import Documents.Property as Property
 import Documents.Object   as Object
-from Documents.AsyncRunner import BatchedOrderedRunner, DocumentRunner
+from Documents.AsyncRunner import BatchedOrderedRunner, DocumentRunner, SyncMode
 from Documents.Writer import OCPObjectWriter
 from Documents.Reader import OCPObjectReader
 from Utils.Errorhandling import isOCPError
@@ -38,21 +38,57 @@ class FreeCADOnlineObject():
     def __init__(self, name, onlinedoc, objGroup, parentOnlineObj = None):
         
         self.logger = logging.getLogger(objGroup[:-1] + " " + name)
+        self._onlinedoc = onlinedoc
+        self._parent = parentOnlineObj
+        self._creation = None   #FinishEpochSyncer of the documents barrier for the creation of the object
                 
-        # check which type of async runner to use 
-        if os.getenv('FC_OCP_SYNC_MODE', "0") == "1":
+        if onlinedoc.syncMode == SyncMode.Document:
             self.logger.info('Use non-default sync mode "Document-Sync"')
-            self._runner     = DocumentRunner.getSenderRunner(onlinedoc.id, self.logger)
         
-        else:
-            if parentOnlineObj is None:
-                self._runner     = BatchedOrderedRunner(self.logger) #used by the object to sync outgoing events
-            else:
-                self._runner     = parentOnlineObj._runner
-
+        self._runner = self._createRunner()
         self.Writer = OCPObjectWriter(name, objGroup, onlinedoc, self.logger)
         self.Reader = OCPObjectReader(name, objGroup, onlinedoc, self.logger)
         
+        
+    def _createRunner(self):
+        # check which type of async runner to use 
+        
+        if self._onlinedoc.syncMode == SyncMode.Document:
+            return DocumentRunner.getSenderRunner(self._onlinedoc.id, self.logger)
+        
+        if self._parent is None:
+            #used by the object to sync outgoing events
+            runner = BatchedOrderedRunner(self.logger, self._onlinedoc.scheduler, self._onlinedoc.highWaterMark)
+            #wait for the creation of other objects and transaction closes, but not while we are created ourself
+            runner.setBarrier(self._onlinedoc.barrier, self._isCreating)
+            return runner
+        
+        return self._parent._runner
+    
+    
+    def _setupRunner(self):
+        # registers batchers and error handlers with the runner, to be implemented by subclasses
+        pass
+    
+    
+    def _isCreating(self):
+        return self._creation is not None and not self._creation.Finished
+    
+    
+    def _switchRunner(self, syncer):
+        # Replaces the runner after the sync mode of the document changed. The new runner only starts after the 
+        # syncer was released. Returns the old runner, which needs to be closed, or None if it was shared
+        
+        old = self._runner
+        self._runner = self._createRunner()
+        self._setupRunner()
+        
+        if self._parent is not None:
+            return None
+        
+        self._runner.sync(syncer)
+        return old
+
 
     async def _docPrints(self):
         uri = u"ocp.documents.{0}.prints".format(self._docId)
@@ -74,6 +110,27 @@ class FreeCADOnlineObject():
     def synchronize(self, syncer):
         self._runner.sync(syncer)
         
+        
+    def hasPendingWork(self):
+        #true if the runner has queued or executing tasks
+        return not self._runner.idle()
+        
+        
+    def _outlist(self):
+        #returns the names of the objects this one depends on
+        return []
+    
+    
+    def _dependencies(self):
+        # returns the runners of the outlist objects if the document orders by dependencies, None otherwise.
+        # The outlist is only computed in this case
+        
+        if self._onlinedoc.syncMode != SyncMode.Dependency:
+            return None
+        
+        objects = self._onlinedoc.objects
+        return [objects[name]._runner for name in self._outlist() if name in objects]
+        
     
     async def download(self, obj):
         # Loads the OCP node data for this object into the FreeCAD one. If changes exist 
@@ -112,14 +169,23 @@ class FreeCADOnlineObject():
             self.logger.debug(f"Create and set dynamic properties {add}")
             Object.createDynamicProperties(obj, add, infos)
             
-            # set all property values. Note that data can be None in case the property was never written (default value)
+            # set all property values. Note that data can be None in case the property was never written (default value).
+            # Properties with a known default value are reset to it, as it may not be written on upload. All others, e.g.
+            # the Label that is not written for objects created after sharing, keep their local value
             values = await self.Reader.properties(oProps)
+            defaults = Property.getDefaultValues(obj)
             writeProps  = []
             writeValues = []
             for prop, value in zip(oProps, values):
-                if value:
+                if value is not None:
                     writeProps.append(prop)
                     writeValues.append(value)
+                    
+                elif prop in defaults:
+                    fp, default = defaults[prop]
+                    if Property.fingerprint(Property.convertPropertyToWamp(obj, prop)) != fp:
+                        writeProps.append(prop)
+                        writeValues.append(default)
 
             self.logger.debug(f"Read properties {writeProps}")
             Object.setProperties(obj, writeProps, writeValues)
@@ -163,11 +229,15 @@ class FreeCADOnlineObject():
             for e in ext:
                 tasks.append(self.Writer.addExtension(e))
             
-            #write all properties.
-            props = obj.PropertiesList
-            for prop in props:
+            #write all properties, except the ones with default value: they are reset to it on download
+            defaults = Property.getDefaultValues(obj)
+            outlist = [o.Name for o in obj.OutList]
+            for prop in obj.PropertiesList:
                 value = Property.convertPropertyToWamp(obj, prop)
-                self.Writer.changeProperty(prop, value, obj.OutList)
+                if prop in defaults and Property.fingerprint(value) == defaults[prop][0]:
+                    continue
+                
+                self.Writer.changeProperty(prop, value, outlist)
             
             tasks.append(self.Writer.processPropertyChanges())
 
@@ -186,9 +256,15 @@ class OnlineObject(FreeCADOnlineObject):
         super().__init__(obj.Name, onlinedoc, "Objects")
         self.recomputeCache = {}
         self.obj            = obj
+        self.outlist        = []    #outlist at the last property change flush
+        self.viewprovider   = None  #the OnlineViewProvider of the object, registered by itself
+        self._setupRunner()
+        
+        
+    def _setupRunner(self):
         
         batchers = [Batcher.EquallityBatcher("OnlineObject.__addDynamicProperty", self.Writer.processDynamicPropertyAdditions),
-                    Batcher.EquallityBatcher("OnlineObject.__changeProperty", self.Writer.processPropertyChanges),
+                    Batcher.EquallityBatcher("OnlineObject.__changeProperty", self.__collectPropertyChanges, pipelined=True),
                     Batcher.EquallityBatcher("OnlineObject.__changePropertyStatus", self.Writer.processPropertyStatusChanges)
         ]
         
@@ -199,11 +275,12 @@ class OnlineObject(FreeCADOnlineObject):
         self._runner.registerBatcher(Batcher.MultiBatcher(cbs))
         
         # error handling
-        self._runner.registerErrorHandler(isOCPError, self.download, obj)
+        self._runner.registerErrorHandler(isOCPError, self.download, self.obj)
         
         
-    def setup(self, syncer=None):
+    def setup(self, syncer=None, creation=None):
         # setup the FC object on the OCP node including all properties
+        # creation is the FinishEpochSyncer of the documents barrier, executed after the setup
         
         infos = []
         for prop in self.obj.PropertiesList:
@@ -219,12 +296,24 @@ class OnlineObject(FreeCADOnlineObject):
         props = Property.getNonDefaultValueProperties(self.obj)
         for prop in props:
             self._runner.run(self.Writer.changeProperty, prop, Property.convertPropertyToWamp(self.obj, prop), [])
+            
+        if creation:
+            self._creation = creation
+            self._runner.sync(creation)
 
     
     def isSettingUp(self):
         return self.Writer.setupStage
     
     def remove(self):
+        #queued changes would only be uploaded to be removed right after, for us as well as for our view provider. 
+        #Setup and removal are kept, so that the node sees a consistent object lifetime
+        drop = lambda task: task.Name not in ("OCPObjectWriter.setup", "OCPObjectWriter.remove")
+        self._runner.purge(drop)
+        if self.viewprovider and self.viewprovider._runner is not self._runner:
+            #in Document-Sync mode the view provider uses its own runner wrapper
+            self.viewprovider._runner.purge(drop)
+            
         self._runner.run(self.Writer.remove)
         
         #we cannot use the runner to run close on itself, because it would wait for itself till it finishes: 
@@ -258,13 +347,25 @@ class OnlineObject(FreeCADOnlineObject):
     
     
     def changeProperty(self, prop):
+        #queues the property change. Returns True if the runner reports backpressure
+        #The outlist is not stored in the task but computed once when the batch of changes is flushed
         value = Property.convertPropertyToWamp(self.obj, prop)
-        outlist = [obj.Name for obj in self.obj.OutList]
-        self._runner.run(self.__changeProperty, prop, value, outlist)
+        return self._runner.run(self.__changeProperty, prop, value, key=("Objects", self.obj.Name, prop), 
+                                after=self._dependencies())
         
-    def __changeProperty(self, prop, value, outlist):
+    def __changeProperty(self, prop, value):
         #indirection for batcher named tasks
-        self.Writer.changeProperty(prop, value, outlist)
+        self.Writer.changeProperty(prop, value)
+        
+    async def __collectPropertyChanges(self):
+        #batch handler: provides the current outlist to the writer
+        try:
+            self.outlist = self._outlist()
+        except:
+            #object already deleted in FreeCAD, keep the last known outlist
+            pass
+        
+        return await self.Writer.collectPropertyChanges(self.outlist)
 
  
     def changePropertyStatus(self, prop):
@@ -276,8 +377,12 @@ class OnlineObject(FreeCADOnlineObject):
         self.Writer.changePropertyStatus(prop, info)
         
     
+    def _outlist(self):
+        return [obj.Name for obj in self.obj.OutList]
+    
+    
     def recompute(self):      
-        self._runner.run(self.Writer.objectRecomputed)
+        self._runner.run(self.Writer.objectRecomputed, after=self._dependencies())
      
      
 
@@ -287,9 +392,14 @@ class OnlineViewProvider(FreeCADOnlineObject):
         super().__init__(obj.Object.Name, onlinedoc, "ViewProviders", parentOnlineObj=onlineobj)
         self.obj = obj
         self.proxydata = None   #as FreeCAD 0.18 does not forward viewprovider proxy changes we need a way to identify changes
+        self._setupRunner()
+        onlineobj.viewprovider = self
+        
+        
+    def _setupRunner(self):
         
         batchers = [Batcher.EquallityBatcher("OnlineViewProvider.__addDynamicProperty", self.Writer.processDynamicPropertyAdditions),
-                    Batcher.EquallityBatcher("OnlineViewProvider.__changeProperty", self.Writer.processPropertyChanges),
+                    Batcher.EquallityBatcher("OnlineViewProvider.__changeProperty", self.Writer.collectPropertyChanges, pipelined=True),
                     Batcher.EquallityBatcher("OnlineViewProvider.__changePropertyStatus", self.Writer.processPropertyStatusChanges)
         ]
         
@@ -300,7 +410,7 @@ class OnlineViewProvider(FreeCADOnlineObject):
         self._runner.registerBatcher(Batcher.MultiBatcher(cbs))
         
         # error handling
-        self._runner.registerErrorHandler(isOCPError, self.download, obj)
+        self._runner.registerErrorHandler(isOCPError, self.download, self.obj)
         
           
     def setup(self, sync=None):
@@ -350,6 +460,7 @@ class OnlineViewProvider(FreeCADOnlineObject):
     
     
     def changeProperty(self, prop):
+        #queues the property change. Returns True if the runner reports backpressure
         
         value = Property.convertPropertyToWamp(self.obj, prop)
         
@@ -359,10 +470,11 @@ class OnlineViewProvider(FreeCADOnlineObject):
             if hasattr(self.obj, 'Proxy'):
                 if not self.proxydata is self.obj.Proxy:
                     self.proxydata = self.obj.Proxy
-                    self._runner.run(self.__changeProperty, 'Proxy', self.obj.dumpPropertyContent('Proxy'), [])
+                    self._runner.run(self.__changeProperty, 'Proxy', self.obj.dumpPropertyContent('Proxy'), 
+                                     key=("ViewProviders", self.obj.Object.Name, 'Proxy'))
             
         
-        self._runner.run(self.__changeProperty, prop, value, [])
+        return self._runner.run(self.__changeProperty, prop, value, key=("ViewProviders", self.obj.Object.Name, prop))
 
 
     def changePropertyStatus(self, prop):
@@ -374,9 +486,9 @@ class OnlineViewProvider(FreeCADOnlineObject):
         #indirection for batcher named tasks
         self.Writer.changePropertyStatus(prop, info)
 
-    def __changeProperty(self, prop, value, outlist):
+    def __changeProperty(self, prop, value):
         #indirection for batcher named tasks
-        self.Writer.changeProperty(prop, value, outlist)
+        self.Writer.changeProperty(prop, value, [])
         
     def __addDynamicProperty(self, prop, info):
         #indirection for batcher named tasks
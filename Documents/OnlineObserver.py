@@ -17,7 +17,7 @@
 # *   Suite 330, Boston, MA  02111-1307, USA                             *
 # ************************************************************************
 
-import FreeCAD, logging, os, asyncio, traceback
+import FreeCAD, logging, asyncio, traceback
 import Documents.Property       as Property
 import Documents.Object         as Object
 import Documents.AsyncRunner    as AsyncRunner
@@ -28,13 +28,21 @@ from Documents.OnlineObject import OnlineViewProvider
 from autobahn.wamp.types    import SubscribeOptions, CallOptions
 from autobahn.wamp          import ApplicationError
 
+#default time in seconds after which runners of objects without incoming events are removed
+DefaultReclaimPeriod = 30
+
 class OnlineObserver():
     
     def __init__(self, odoc):
       
         self.onlineDoc = odoc
         self.logger = logging.getLogger("Online observer " + odoc.id[-5:])
+        self.scheduler = AsyncRunner.DocumentScheduler(self.logger) #drains the incoming runners of all objects
         self.runners = {}      
+        self.reclaimPeriod = DefaultReclaimPeriod
+        self.__used = set()     #names of runners requested since the last reclaim sweep
+        self.__reclaimer = None
+        self.__switching = None #syncer new runners wait for while the sync mode is switched
 
     async def setup(self):
         # setups all async things
@@ -46,6 +54,7 @@ class OnlineObserver():
                 "Objects..onObjectRecomputed": self.__cbObjectRecomputed,
                 "Objects..onExtensionCreated": self.__cbCreateObjextExtension,
                 "Objects..onExtensionRemoved": self.__cbRemoveObjextExtension,       
+                "Objects..onDependenciesChanged": self.__cbChangeObjectDependencies,
                 "Objects...onDynamicPropertyCreated": self.__cbCreateObjectDynProperty,
                 "Objects...onDynamicPropertiesCreated": self.__cbCreateObjectDynProperties,
                 "Objects...onDynamicPropertyRemoved": self.__cbRemoveObjectDynProperty,
@@ -66,10 +75,8 @@ class OnlineObserver():
         self.docCBs = {
             }
         
-        if os.getenv('FC_OCP_SYNC_MODE', "0") == "1":
-            self.synced = True
-        else:
-            self.synced = False
+        #incoming events are ordered by the node already, hence only Document-Sync changes the receive runners
+        self.synced = self.onlineDoc.syncMode == AsyncRunner.SyncMode.Document
         
         try:
             # careful: any change here must be also changed for close and unsubscribe!
@@ -82,9 +89,16 @@ class OnlineObserver():
            
         except Exception as e:
             self.logger.error("Setup failed: ", e)
+            
+        if not self.synced and self.reclaimPeriod > 0:
+            self.__reclaimer = asyncio.ensure_future(self.__reclaim())
 
      
     async def close(self):
+        if self.__reclaimer:
+            self.__reclaimer.cancel()
+            self.__reclaimer = None
+            
         tasks = []
         for runner in self.runners.values():
             tasks.append(runner.close())
@@ -94,7 +108,8 @@ class OnlineObserver():
         if tasks:
             await asyncio.gather(*tasks)
             
-        self.runners = []
+        await self.scheduler.close()
+        self.runners = {}
      
         
     async def __run(self, *args, details=None):
@@ -152,23 +167,74 @@ class OnlineObserver():
 
     def getRunner(self, name):
         
+        self.__used.add(name)
         if not name in self.runners:
             if self.synced:
                 self.runners[name] = AsyncRunner.DocumentRunner.getReceiverRunner(self.onlineDoc.id, self.logger)
             else:
-                self.runners[name] = AsyncRunner.OrderedRunner(self.logger)
+                self.runners[name] = AsyncRunner.OrderedRunner(self.logger, self.scheduler)
+                
+            if self.__switching:
+                self.runners[name].sync(self.__switching)
                 
         return self.runners[name]
     
     
+    async def switchSyncMode(self, syncer):
+        # Replaces all runners after the sync mode of the document changed. Runners created for new events wait for 
+        # the syncer, which is released after this function returns: the old runners are closed by then
+        
+        self.synced = self.onlineDoc.syncMode == AsyncRunner.SyncMode.Document
+        self.__switching = syncer
+        old = self.runners
+        self.runners = {}
+        
+        if self.synced and self.__reclaimer:
+            self.__reclaimer.cancel()
+            self.__reclaimer = None
+            
+        elif not self.synced and not self.__reclaimer and self.reclaimPeriod > 0:
+            self.__reclaimer = asyncio.ensure_future(self.__reclaim())
+            
+        try:
+            #the shared document runner is kept alive, it is also used by the online objects
+            closing = [runner.close() for runner in old.values() if isinstance(runner, AsyncRunner.OrderedRunner)]
+            if closing:
+                await asyncio.gather(*closing)
+                
+        finally:
+            self.__switching = None
+    
+    
     async def closeRunner(self, name):
         
         if name in self.runners and not self.synced:
             await self.runners[name].close()
             del self.runners[name]
+            
+            
+    async def __reclaim(self):
+        # Runners of objects that did not receive events for a while are dropped, they are recreated on the next
+        # event. A runner is removed if it is idle and was not used during a whole period, hence after a quiet
+        # time between one and two periods.
+        
+        while True:
+            await asyncio.sleep(self.reclaimPeriod)
+            
+            unused = [name for name, runner in self.runners.items() if name not in self.__used and runner.idle()]
+            for name in unused:
+                del self.runners[name]
+                
+            self.__used = set()
+            if unused:
+                self.logger.debug(f"Reclaimed {len(unused)} idle runners")
 
 
     async def waitTillCloseout(self, timeout = 10):
+        if not self.synced:
+            await self.scheduler.waitTillCloseout(timeout)
+            return
+        
         coros = []
         for runner in self.runners.values():
             coros.append(runner.waitTillCloseout(timeout))
@@ -249,7 +315,7 @@ class OnlineObserver():
         if obj is None:
             return
         
-        await self.__setProperty(obj, prop, value, f"Object ({name})")
+        await self.__setProperty(obj, prop, value, f"Object ({name})", self.onlineDoc.objects.get(name, None))
         
         
     async def __cbChangeMultiObject(self, name, props, values):
@@ -258,9 +324,16 @@ class OnlineObserver():
         if obj is None:
             return
         
-        await self.__setProperties(obj, props, values, f"Object ({name})")
+        await self.__setProperties(obj, props, values, f"Object ({name})", self.onlineDoc.objects.get(name, None))
  
  
+    async def __cbChangeObjectDependencies(self, name, deps):
+        #keeps the writers knowledge of the node dependencies up to date, so that it only writes changed ones
+        
+        if name in self.onlineDoc.objects:
+            self.onlineDoc.objects[name].Writer.setNodeDependencies(deps)
+            
+        
     async def __cbChangePropStatus(self, name, prop, status):
         
         try:
@@ -316,6 +389,8 @@ class OnlineObserver():
             
             self.logger.debug(f"Object ({name}): Remove dynamic property {prop}")
             Object.removeDynamicProperty(obj, prop)
+            if name in self.onlineDoc.objects:
+                self.onlineDoc.objects[name].Writer.forgetProperty(prop)
             
         except Exception as e:
             self.logger.error(f"Dyn property removing failed: {e.message}")
@@ -402,7 +477,8 @@ class OnlineObserver():
         if obj is None:
             return
  
-        await self.__setProperty(obj.ViewObject, prop, value, f"ViewProvider ({name})")
+        await self.__setProperty(obj.ViewObject, prop, value, f"ViewProvider ({name})", 
+                                 self.onlineDoc.viewproviders.get(name, None))
      
     
     async def __cbChangeMultiViewProdiver(self, name, props, values):
@@ -411,7 +487,8 @@ class OnlineObserver():
         if obj is None:
             return
                
-        await self.__setProperties(obj.ViewObject, props, values, f"ViewProvider ({name})")
+        await self.__setProperties(obj.ViewObject, props, values, f"ViewProvider ({name})", 
+                                   self.onlineDoc.viewproviders.get(name, None))
      
     
     async def __cbChangeViewProvierPropStatus(self, name, prop, status):
@@ -472,6 +549,8 @@ class OnlineObserver():
             
             self.logger.debug(f"ViewProvider ({name}): Remove dynamic property {prop}")
             Object.removeDynamicProperty(obj.ViewObject, prop)
+            if name in self.onlineDoc.viewproviders:
+                self.onlineDoc.viewproviders[name].Writer.forgetProperty(prop)
         
         except Exception as e:
             self.logger.error(f"Dynamic property removing callback failed: {e.message}")
@@ -540,6 +619,7 @@ class OnlineObserver():
 
     async def __getBinaryValues(self, values):
         #checks all values for binary Cid's and fetches the real data to replace it with
+        #Note: small binary values are written inline and hence received as bytes directly
         
         if not isinstance(values, list):
             values = [values]
@@ -582,24 +662,31 @@ class OnlineObserver():
         return values
 
 
-    async def __setProperty(self, obj, prop,  value, logentry):
+    async def __setProperty(self, obj, prop,  value, logentry, online=None):
+        #online is the online object or viewprovider of obj, which is informed about the received value
         
         try:                      
             self.logger.debug(f"{logentry}: Set property {prop}")
             
             value = await self.__getBinaryValues(value)
+            if online:
+                online.Writer.setReceivedValues([prop], [value])
             Object.setProperty(obj, prop, value)
 
         except Exception as e:
             self.logger.error(f"{logentry} Set property {prop} error: {e}")
     
     
-    async def __setProperties(self, obj, props, values, logentry):
+    async def __setProperties(self, obj, props, values, logentry, online=None):
         
         try:      
             self.logger.debug(f"{logentry}: Set properties {props}")
             
             values = await self.__getBinaryValues(values)
+            if len(props) == 1:
+                values = [values]   #a single value is returned unpacked
+            if online:
+                online.Writer.setReceivedValues(props, values)
             Object.setProperties(obj, props, values)
            
         except Exception as e:
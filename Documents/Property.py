@@ -21,8 +21,10 @@
 #
 # 1. Status handling needs some translation between 0.18 and 0.19 versions
 # 2. Properties need to be translated into serializable and storable types
+# 3. Default values are known per TypeId, to not transfer them
 
 
+import hashlib
 import FreeCAD as App
 
 __typeToStatusMap__ = {
@@ -38,6 +40,16 @@ __non_default_property_types__ = [
     "App::PropertyUUID"
 ]
 
+#list of properties FreeCAD sets from the object name before the object is announced, hence they are never written 
+#for objects created after sharing and the node has no value for them
+__name_properties__ = [
+    "Label",
+    "Label2"
+]
+
+#typeid -> property -> (fingerprint, value) of the default values in wamp format
+__default_values__ = {}
+
 def createInformation(obj, prop):
     info = {}
     info["docu"] = obj.getDocumentationOfProperty(prop)
@@ -118,6 +130,66 @@ def convertWampToProperty(obj, prop, value):
     converter(obj, prop, value)
 
 
+def fingerprint(value):
+    # 64 bit hash of a property value in wamp format. Binary data is hashed by content, all other values by their
+    # representation
+    
+    if isinstance(value, (bytes, bytearray)):
+        return hashlib.blake2b(value, digest_size=8, person=b"binary").digest()
+    
+    return hashlib.blake2b(repr(value).encode(), digest_size=8, person=b"value").digest()
+
+
+def getDefaultValues(obj):
+    # Returns the default values of the properties of the objects type as dict property -> (fingerprint, value). 
+    # Only properties every new object of the type has with the same value are included. The values are read 
+    # once per TypeId from two scratch objects with different names in different documents, values depending on
+    # those are not included. View providers have no default values
+    
+    if not obj.isDerivedFrom("App::DocumentObject"):
+        return {}
+    
+    if obj.TypeId not in __default_values__:
+        __default_values__[obj.TypeId] = __readDefaultValues(obj.TypeId)
+        
+    return __default_values__[obj.TypeId]
+
+
+def __readDefaultValues(typeid):
+    
+    result = {}
+    active = App.ActiveDocument
+    docs = []
+    try:
+        #temporary documents are not handled by the collaboration manager
+        for name in ["OCPDefaultValuesA", "OCPDefaultValuesB"]:
+            docs.append(App.newDocument(name, hidden=True, temp=True))
+            
+        scratch = docs[0].addObject(typeid, "ScratchA")
+        other   = docs[1].addObject(typeid, "ScratchB")
+        for prop in scratch.PropertiesList:
+            if prop in __name_properties__ or scratch.getTypeIdOfProperty(prop) in __non_default_property_types__:
+                continue
+            
+            value = convertPropertyToWamp(scratch, prop)
+            fp = fingerprint(value)
+            if prop not in other.PropertiesList or fingerprint(convertPropertyToWamp(other, prop)) != fp:
+                continue
+            
+            result[prop] = (fp, value)
+            
+    except Exception as e:
+        App.Console.PrintWarning(f"No default values available for {typeid}: {e}\n")
+        
+    finally:
+        for doc in docs:
+            App.closeDocument(doc.Name)
+        if active:
+            App.setActiveDocument(active.Name)
+        
+    return result
+
+
 def getNonDefaultValueProperties(obj):
     
     result = []
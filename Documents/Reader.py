@@ -148,6 +148,7 @@ class OCPObjectReader():
     
     async def __getBinaryValues(self, values):
         # checks all values for binary Cid's and fetches the real data to replace it with
+        # Note: small binary values are written inline and hence received as bytes directly
         
         if not isinstance(values, list):
             values = [values]
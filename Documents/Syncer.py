@@ -79,3 +79,87 @@ class AcknowledgeBlockSyncer():
     def restart(self):
         self.Block.restart()
      
+
+
+class EpochBarrier():
+    #Document wide barrier: tasks queued while an epoch is open must not execute before it is finished, e.g. an object
+    #creation or a transaction close. Epochs are numbered. Runners stamp each task with the current epoch when it is
+    #queued, and check lazily before executing it if all epochs started earlier are finished. Starting an epoch hence
+    #does not touch any runner, independent of the document size. Epochs can be softened: pipelined tasks, which 
+    #only prepare writes that are gated elsewhere, do not wait for them anymore
+    
+    def __init__(self):
+        self.Epoch = 0
+        self.__pending = {}     #unfinished epoch -> callbacks waiting for it
+        self.__soft = set()     #softened unfinished epochs
+        
+    def begin(self):
+        #starts an epoch. Returns the syncer that finishes it when executed
+        
+        epoch = self.Epoch
+        self.Epoch += 1
+        self.__pending[epoch] = []
+        return FinishEpochSyncer(self, epoch)
+        
+    def passes(self, epoch, pipelined = False):
+        #true if all epochs started before the given one are finished
+        return self.__blocking(epoch, pipelined) is None
+    
+    def wait(self, epoch, callback, pipelined = False):
+        #calls the callback when the oldest unfinished epoch before the given one is finished. Returns False if
+        #nothing needs to be waited for
+        
+        blocking = self.__blocking(epoch, pipelined)
+        if blocking is None:
+            return False
+        
+        self.__pending[blocking].append(callback)
+        return True
+    
+    def soften(self, epoch):
+        #pipelined tasks do not need to wait for the epoch anymore. Waiting ones are called to check again
+        
+        if epoch not in self.__pending:
+            return
+        
+        self.__soft.add(epoch)
+        callbacks = self.__pending[epoch]
+        self.__pending[epoch] = []
+        for callback in callbacks:
+            callback()
+        
+    def finish(self, epoch):
+        
+        self.__soft.discard(epoch)
+        for callback in self.__pending.pop(epoch, []):
+            callback()
+            
+    def __blocking(self, epoch, pipelined):
+        #returns the oldest unfinished epoch the task of the given epoch needs to wait for, None if there is none
+        
+        for pending in self.__pending:
+            if pending >= epoch:
+                return None
+            if not (pipelined and pending in self.__soft):
+                return pending
+            
+        return None
+            
+
+class FinishEpochSyncer():
+    #finishes an epoch of an EpochBarrier when executed
+    
+    def __init__(self, barrier, epoch):
+        self.__barrier = barrier
+        self.__epoch = epoch
+        self.Finished = False
+        
+    async def execute(self):
+        self.finish()
+        
+    def soften(self):
+        self.__barrier.soften(self.__epoch)
+        
+    def finish(self):
+        self.Finished = True
+        self.__barrier.finish(self.__epoch)
@@ -17,8 +17,312 @@
 # *   Suite 330, Boston, MA  02111-1307, USA                             *
 # ************************************************************************
 
-import asyncio, FreeCAD
+import asyncio, hashlib, FreeCAD
+from collections import OrderedDict
 import Documents.Property as Property
+from Documents.Metrics import CacheMetrics, WriteMetrics
+from autobahn.wamp.exception import ApplicationError
+
+DefaultCidCacheSize = 1024  #number of binary hashes for which the CID is remembered
+DefaultInlineSize   = 4096  #binary values up to this size in bytes are written inline instead of uploaded by CID
+
+
+class CidCache():
+    ''' Maps the content hash of binary data to the CID the node returned for it
+    
+        Binary property values, e.g. shapes, often are uploaded multiple times with the same content (undo/redo, 
+        toggling, identical copies). The cache allows to reuse the CID without uploading the data again. It holds 
+        the futures of the CID requests, hence also concurrent uploads of the same data are done only once. The 
+        least recently used entries are evicted when the size is exceeded.
+        
+        Init:
+        size - Maximal number of cached CIDs
+    '''
+    
+    def __init__(self, size = DefaultCidCacheSize):
+        
+        self.size       = size
+        self.Metrics    = CacheMetrics()
+        self.__entries  = OrderedDict()     #hash -> future with CID as result
+        
+        
+    def key(self, data):
+        return hashlib.sha256(data).digest()
+        
+        
+    def get(self, key, size):
+        # Returns the future of the CID for the data with the given key, or None if unknown. size is the data size 
+        # recorded as saved on a hit
+        
+        future = self.__entries.get(key, None)
+        if future is None:
+            self.Metrics.recordMiss()
+            return None
+        
+        self.__entries.move_to_end(key)
+        self.Metrics.recordHit(size)
+        return future
+    
+    
+    def add(self, key, future):
+        # Adds the future of a CID request. If it fails the entry is removed again
+        
+        self.__entries[key] = future
+        self.__entries.move_to_end(key)
+        future.add_done_callback(lambda fut: self.__requestDone(key, fut))
+        
+        while len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+            self.Metrics.Evictions += 1
+            
+            
+    def clear(self):
+        self.__entries.clear()
+        
+        
+    def __requestDone(self, key, future):
+        
+        if future.cancelled() or future.exception() is not None:
+            if self.__entries.get(key, None) is future:
+                del self.__entries[key]
+
+class OCPDocumentWriter():
+    ''' Collects writes of many object writers and executes them in single calls to the OCP node
+    
+        Object writers hand their cached data to the document writer instead of writing it themself. All data 
+        collected during one iteration of the event loop, e.g. all batches the runners of a document execute after a
+        recompute, is written with one call per object group.
+        
+        Init:
+        onlinedoc - The onlinedocument the writers belong to
+        logger    - The logger to use for messaging
+    '''
+    
+    def __init__(self, onlinedoc, logger):
+        
+        self.logger         = logger
+        self.docId          = onlinedoc.id
+        self.data           = onlinedoc.data
+        self.connection     = onlinedoc.connection
+        self.__objects      = {}    #object group -> list of (name, typeid, template, props, infos, logger, future)
+        self.__templates    = {}    #object group -> typeid -> (template id, property -> info)
+        self.__newTemplates = {}    #object group -> list of [template id, props, infos] to register
+        self.__values       = {}    #object group -> list of (name, props, values, deps, logger, future)
+        self.__scheduled    = False
+        self.__held         = 0     #number of hold calls not yet released
+        self.__binaries     = []    #list of (data, future) to resolve the CIDs for
+        self.__bulkCids     = True  #False if the CidByBinaries call of the node failed
+        self.cids           = CidCache()
+        self.inlineSize     = DefaultInlineSize
+        self.Metrics        = WriteMetrics()
+        
+        
+    def hold(self):
+        # Collected writes are not sent till release is called, e.g. while a transaction is closed
+        self.__held += 1
+        
+        
+    def release(self):
+        
+        self.__held -= 1
+        if not self.__held and (self.__objects or self.__values):
+            self.__schedule()
+        
+        
+    def newObject(self, group, name, typeid, props, infos, logger):
+        # Queues the creation of an object including the setup of its properties. Returns a future that is done
+        # when the object is created, with True as result on success. Errors are logged with the given logger of the
+        # object writer
+        
+        template, infos = self.__applyTemplate(group, typeid, props, infos)
+        
+        future = asyncio.get_event_loop().create_future()
+        self.__objects.setdefault(group, []).append((name, typeid, template, props, infos, logger, future))
+        self.__schedule()
+        return future
+        
+        
+    def __applyTemplate(self, group, typeid, props, infos):
+        # Returns the id of the property info template for objects of the given type, and the infos with None for
+        # all entries equal to the template. The first object of a type defines the template, which is registered
+        # in the node together with the object creation. The id contains the content hash, hence templates of 
+        # different clients (e.g. FreeCAD versions) do not collide
+        
+        known = self.__templates.setdefault(group, {})
+        if typeid not in known:
+            template = f"{typeid}:{Property.fingerprint((props, infos)).hex()}"
+            known[typeid] = (template, dict(zip(props, infos)))
+            self.__newTemplates.setdefault(group, []).append([template, props, infos])
+            
+        template, templInfos = known[typeid]
+        return template, [None if templInfos.get(prop, None) == info else info for prop, info in zip(props, infos)]
+        
+        
+    def setValues(self, group, name, props, values, deps, logger):
+        # Queues the property values of an object for writing. deps are the new dependencies of the object, or None
+        # to keep the current ones. Returns a future that is done when the values are written, with True as result 
+        # if the node stored all values (and deps). Errors are logged with the given logger of the object writer
+        
+        future = asyncio.get_event_loop().create_future()
+        self.__values.setdefault(group, []).append((name, props, values, deps, logger, future))
+        self.__schedule()
+        return future
+    
+    
+    def cidForData(self, data):
+        # Returns a future with the CID of the binary data as result. Data uploaded before (or currently uploading) 
+        # is not transferred again. All other data requested during one event loop iteration is registered in the 
+        # data service together and the CIDs are resolved with a single call. Note: the future can be shared, 
+        # do not cancel it
+        
+        key = self.cids.key(data)
+        future = self.cids.get(key, len(data))
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self.cids.add(key, future)
+            
+            if not self.__binaries:
+                asyncio.get_event_loop().call_soon(self.__flushBinaries)
+            self.__binaries.append((data, future))
+            
+        return future
+    
+    
+    def __flushBinaries(self):
+        
+        asyncio.ensure_future(self.__resolveCids(self.__binaries))
+        self.__binaries = []
+        
+        
+    async def __resolveCids(self, entries):
+        
+        futures = [entry[1] for entry in entries]
+        try:
+            #make the data available in the provider
+            keys = self.data.addDatas([entry[0] for entry in entries])
+            
+            cids = None
+            if self.__bulkCids and len(keys) > 1:
+                try:
+                    uri = f"ocp.documents.{self.docId}.raw.CidByBinaries"
+                    cids = await self.connection.api.call(uri, self.data.uri, keys)
+                    
+                except ApplicationError as e:
+                    #the node may not provide the bulk call, or register raw.* by prefix and fail differently. The
+                    #batch is retried with single calls, which all nodes support
+                    self.logger.debug(f"Bulk CID resolution failed, fallback to single calls: {e}")
+                    self.__bulkCids = False
+            
+            if cids is None:
+                uri = f"ocp.documents.{self.docId}.raw.CidByBinary"
+                cids = await asyncio.gather(*[self.connection.api.call(uri, self.data.uri, key) for key in keys])
+                
+            for future, cid in zip(futures, cids):
+                future.set_result(cid)
+                
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+    
+    
+    def __schedule(self):
+        
+        if not self.__scheduled:
+            self.__scheduled = True
+            asyncio.get_event_loop().call_soon(self.__flush)
+    
+    
+    def __flush(self):
+        
+        self.__scheduled = False
+        if self.__held:
+            return
+        
+        asyncio.ensure_future(self.__write(self.__objects, self.__newTemplates, self.__values))
+        self.__objects      = {}
+        self.__newTemplates = {}
+        self.__values       = {}
+        
+        
+    async def __write(self, objects, templates, values):
+        #objects are created first, the values may belong to them
+        
+        if objects:
+            await asyncio.gather(*[self.__createObjects(group, entries, templates.get(group, []))
+                                   for group, entries in objects.items()])
+            
+        if values:
+            await asyncio.gather(*[self.__writeValues(group, entries) for group, entries in values.items()])
+    
+    
+    async def __createObjects(self, group, entries, templates):
+        
+        failed = [entry[0] for entry in entries]
+        try:
+            names     = [entry[0] for entry in entries]
+            typeids   = [entry[1] for entry in entries]
+            templIds  = [entry[2] for entry in entries]
+            props     = [entry[3] for entry in entries]
+            infos     = [entry[4] for entry in entries]
+            
+            self.logger.debug(f"New objects {names}")
+            uri = f"ocp.documents.{self.docId}.content.Document.{group}.NewObjects"
+            failed = await self.connection.api.call(uri, names, typeids, props, infos, templIds, templates) or []
+            
+            for name, typeid, template, props, infos, logger, future in entries:
+                if name in failed:
+                    logger.error("Setup error: Object could not be created")
+                    self.Metrics.Failed += 1
+                    
+        except Exception as e:
+            #the templates may not be registered, the next objects of the types need to provide them again
+            known = self.__templates.get(group, {})
+            for template in templates:
+                typeid = template[0].rsplit(":", 1)[0]
+                if typeid in known and known[typeid][0] == template[0]:
+                    del known[typeid]
+                    
+            for entry in entries:
+                entry[5].error("Setup error: {0}".format(e))
+            self.Metrics.Failed += len(entries)
+                
+        finally:
+            for entry in entries:
+                if not entry[6].done():
+                    entry[6].set_result(entry[0] not in failed)
+    
+    
+    async def __writeValues(self, group, entries):
+        
+        try:
+            names  = [entry[0] for entry in entries]
+            props  = [entry[1] for entry in entries]
+            values = [entry[2] for entry in entries]
+            deps   = [entry[3] for entry in entries]
+            
+            self.logger.debug(f"Write properties of {names}")
+            uri = f"ocp.documents.{self.docId}.content.Document.{group}.SetValuesMulti"
+            failed = await self.connection.api.call(uri, names, props, values, deps)
+            
+            for name, props, values, deps, logger, future in entries:
+                if failed and name in failed:
+                    logger.error(f"Batch writing properties failed: Properties {failed[name]} failed")
+                    self.Metrics.Failed += 1
+                    future.set_result(False)
+                    
+        except Exception as e:
+            for name, props, values, deps, logger, future in entries:
+                logger.error(f"Batch writing properties {props} failed: {e}")
+                if not future.done():
+                    future.set_result(False)
+            self.Metrics.Failed += len(entries)
+                
+        finally:
+            for entry in entries:
+                if not entry[5].done():
+                    entry[5].set_result(True)
+    
 
 class OCPObjectWriter():
     ''' Writes object data to the OCP node document
@@ -52,12 +356,16 @@ class OCPObjectWriter():
         self.docId              = onlinedoc.id
         self.data               = onlinedoc.data
         self.connection         = onlinedoc.connection
+        self.documentWriter     = onlinedoc.writer
         self.name               = name
         self.objGroup           = fctype
         self.dynPropCache       = {}
         self.statusPropCache    = {}
         self.propChangeCache    = {}
         self.propChangeOutlist  = []
+        self.nodeOutlist        = None  #sorted dependencies stored in the node, None if unknown
+        self.nodePrints         = {}    #property -> fingerprint of the value last written or received
+        self.pendingPrints      = {}    #property -> fingerprint of the value currently written
         self.setupStage         = True
 
     
@@ -69,22 +377,21 @@ class OCPObjectWriter():
             self.logger.error(f"Queriying availablitiy failed: {e}")
             
 
-    async def setup(self, typeid, properties, infos):
-        #creates the object in the ocp node
+    def setup(self, typeid, properties, infos):
+        #creates the object in the ocp node. The creation is done by the document writer together with other new 
+        #objects, the returned future is done when the object is setup
     
         self.logger.debug(f"New object {self.name} ({typeid})")
-
-        try:           
-            uri = u"ocp.documents.{0}".format(self.docId)
-            await self.connection.api.call(uri + u".content.Document.{0}.NewObject".format(self.objGroup), self.name, typeid)
-            
-            #create all properties that need setup           
-            await self.__createProperties(False, properties, infos)
-            
-            self.setupStage = False
         
-        except Exception as e:
-            self.logger.error("Setup error: {0}".format(e))
+        created = self.documentWriter.newObject(self.objGroup, self.name, typeid, properties, infos, self.logger)
+        created.add_done_callback(self.__setupFinished)
+        return created
+    
+    
+    def __setupFinished(self, created):
+        
+        if not created.cancelled() and created.result():
+            self.setupStage = False
            
     
     async def __createProperty(self, dynamic, prop, info):
@@ -121,6 +428,7 @@ class OCPObjectWriter():
 
     
     async def removeProperty(self, prop):
+        self.forgetProperty(prop)
         try:        
             self.logger.debug(f"Remove property {prop}")
             uri = u"ocp.documents.{0}.content.Document.{1}.{2}.Properties.RemoveDynamicProperty".format(self.docId, self.objGroup, self.name)
@@ -207,91 +515,136 @@ class OCPObjectWriter():
             self.logger.error("Change property status from cache failed: {0}".format(e))
             
     
-    def changeProperty(self, prop, value, outlist):        
+    def changeProperty(self, prop, value, outlist=None):        
         # change a property to new value and outlist. Note: Value must be already in serializabe format
-        # Not async as it will be batched by runner
+        # Not async as it will be batched by runner. If no outlist is given it must be provided when collecting
         
         self.propChangeCache[prop] = value
-        self.propChangeOutlist = outlist #we are only interested in the last set outlist, not intermediate steps
+        if outlist is not None:
+            self.propChangeOutlist = outlist #we are only interested in the last set outlist, not intermediate steps
     
     
-    async def __getCidForData(self, data):               
-        #store the data for the processing!
+    def setReceivedValues(self, props, values):
+        # Records the property values received from the node, so that writing the same values again is suppressed.
+        # If a value differs from one currently written by us the node value is unknown till our write is done
+        
+        for prop, value in zip(props, values):
+            
+            fp = Property.fingerprint(value)
+            pending = self.pendingPrints.get(prop, None)
+            if pending is not None and pending != fp:
+                self.nodePrints.pop(prop, None)
+            else:
+                self.nodePrints[prop] = fp
+                
+                
+    def forgetProperty(self, prop):
+        # The node value of the property is unknown, e.g. as it was removed
+        self.nodePrints.pop(prop, None)
         
-        #make the data available in the provider
-        datakey = self.data.addData(data)
         
-        #get the cid!
-        uri = f"ocp.documents.{self.docId}.raw.CidByBinary"
-        cid = await self.connection.api.call(uri, self.data.uri, datakey)
-        return cid
+    def setNodeDependencies(self, deps):
+        # Sets the dependencies stored in the node, as reported by the node dependency change events
         
+        self.nodeOutlist = sorted(deps) if deps is not None else None
+    
     
     async def processPropertyChanges(self):
-        # Process all property changes
+        # Process all property changes. Returns when they are written to the node
+        
+        written = await self.collectPropertyChanges()
+        if written:
+            await written
+    
+    
+    async def collectPropertyChanges(self, outlist=None):
+        # Hands all property changes to the document writer, which writes them together with the ones of other 
+        # objects. Returns a future that is done when the values are written, or None if nothing needs to be written.
+        # outlist is the current outlist of the object, if not given the one provided with the changes is used
                  
         if not self.propChangeCache:
-            return
+            return None
 
         #copy everything before first async op
         props = self.propChangeCache.copy()
         self.propChangeCache.clear()
-        out = self.propChangeOutlist.copy()
-        self.propChangeOutlist.clear()
-        out.sort()
-               
+        out = sorted(outlist if outlist is not None else self.propChangeOutlist)
+        self.propChangeOutlist = []
+        
+        #skip all values the node already has. The others are assumed to be in the node when written, so that
+        #identical changes following before the write is done are skipped too
+        prints = {}
+        metrics = self.documentWriter.Metrics
+        for prop in list(props):
+            fp = Property.fingerprint(props[prop])
+            if self.nodePrints.get(prop, None) == fp:
+                del props[prop]
+                metrics.Suppressed += 1
+                continue
+
+            prints[prop] = fp
+            self.nodePrints[prop] = fp
+            self.pendingPrints[prop] = fp
+
+        if not props:
+            return None
+
+        metrics.Written += len(props)
+
         try:
-                
-            #get the cids for the binary properties in parallel
+
+            #small binary values are written inline, for all others we get the cids in parallel
             tasks = []
             for prop in props:
-                if isinstance(props[prop], bytearray): 
+                if isinstance(props[prop], bytearray):
                     
+                    if len(props[prop]) <= self.documentWriter.inlineSize:
+                        props[prop] = bytes(props[prop])
+                        continue
+
                     async def run(props, prop):
-                        cid = await self.__getCidForData(props[prop])
+                        #shielded, as the request may be shared with other writers
+                        cid = await asyncio.shield(self.documentWriter.cidForData(props[prop]))
                         props[prop] = cid
-                        
-                    tasks.append(run(props, prop))
-
-            #also in parallel: query the current outlist (to not update everytime a property changes)
-            if self.objGroup == "Objects":
-                outlist = []
-                async def getOutlist():
-                    uri = f"ocp.documents.{self.docId}.content.Document.{self.objGroup}.{self.name}.dependencies"
-                    outlist = await self.connection.api.call(uri)
-                    if outlist:
-                        outlist.sort()
-                    
-                tasks.append(getOutlist())
 
+                    tasks.append(run(props, prop))
 
             #execute all parallel tasks
             if tasks:
-                await asyncio.wait(tasks)
-            
-            #now batchwrite all properties in correct order
-            if len(props) == 1:
-                prop = list(props.keys())[0]
-                self.logger.debug(f"Write property {prop}")
-                uri = f"ocp.documents.{self.docId}.content.Document.{self.objGroup}.{self.name}.Properties.{prop}.SetValue"
-                await self.connection.api.call(uri, list(props.values())[0])
-            else:
-                self.logger.debug(f"Write properties {list(props.keys())}")
-                uri = u"ocp.documents.{0}.content.Document.{1}.{2}.Properties.SetValues".format(self.docId, self.objGroup, self.name)
-                failed = await self.connection.api.call(uri, list(props.keys()), list(props.values()))
-                if failed:
-                    raise Exception(f"Properties {failed} failed")
-
-            #finally process the outlist
-            if self.objGroup == "Objects" and out != outlist:
-                self.logger.debug(f"Set Outlist")
-                uri = f"ocp.documents.{self.docId}.content.Document.{self.objGroup}.{self.name}.dependencies"
-                await self.connection.api.call(uri, out)
-                
+                await asyncio.gather(*tasks)
+
+            #the dependencies are written together with the values, but only if they differ from the ones we know
+            #to be stored in the node
+            deps = None
+            if self.objGroup == "Objects" and out != self.nodeOutlist:
+                deps = out
+
+            future = self.documentWriter.setValues(self.objGroup, self.name, list(props.keys()), list(props.values()),
+                                                   deps, self.logger)
+            future.add_done_callback(lambda fut: self.__valuesWritten(not fut.cancelled() and fut.result(), prints, deps))
+            return future
+
         except Exception as e:
             self.logger.error(f"Batch writing properties {list(props.keys())} failed: {e}")
-        
-        
+            self.documentWriter.Metrics.Failed += 1
+            self.__valuesWritten(False, prints, None)
+            return None
+
+
+    def __valuesWritten(self, success, prints, deps):
+
+        if success and deps is not None:
+            self.nodeOutlist = deps
+
+        for prop, fp in prints.items():
+            if self.pendingPrints.get(prop, None) == fp:
+                del self.pendingPrints[prop]
+
+            #the node value is unknown if the write failed
+            if not success and self.nodePrints.get(prop, None) == fp:
+                del self.nodePrints[prop]
+
+
     async def addExtension(self, extension, props=None, infos=None):
         #adds the extension including the new properties
         
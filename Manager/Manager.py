@@ -164,6 +164,10 @@ class Manager(QtCore.QObject, Utils.AsyncSlotObject):
         if self.__blockLocalEvents:
             return
         
+        #temporary documents are internal helpers, e.g. to read default values, and are never shared
+        if getattr(doc, "Temporary", False):
+            return
+        
         #If a document was opened in freecad this function makes it known to the Handler. 
         entity = Entity(id = None, status = Entity.Status.local, onlinedoc = None, fcdoc = doc, manager=None)
         self.__entities.append(entity)
@@ -179,6 +183,8 @@ class Manager(QtCore.QObject, Utils.AsyncSlotObject):
             return
         
         entity = self.getEntity('fcdoc', doc)
+        if entity is None:
+            return
         
         if entity.status == Entity.Status.local:
             # we can remove the entity if it is local only